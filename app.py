@@ -6,6 +6,7 @@ import logging
 import os
 import time
 import hmac
+import hashlib
 from hashlib import sha1
 import base64
 import uuid
@@ -13,6 +14,27 @@ import requests
 import threading
 from threading import Thread
 import sys
+import weakref
+import math
+import queue
+import sqlite3
+import bisect
+import re
+from collections import OrderedDict
+try:
+    import fcntl
+except ImportError:  # Windows: 回退为进程内限流
+    fcntl = None
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import image_derivatives
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+import httpx
+from requests.adapters import HTTPAdapter
+import urllib3
+from urllib3.util.retry import Retry
 
 app = Flask(__name__)
 CORS(app)
@@ -21,11 +43,59 @@ CORS(app)
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# 存储聊天历史的内存数据库（生产环境应使用真实数据库）
-chat_sessions = {}
-
-# 存储图片生成任务的状态
-image_generation_tasks = {}
+# 聊天历史存储：CHAT_STORE=memory（默认，进程内）或 sqlite（WAL，多worker共享）
+CHAT_STORE = os.getenv("CHAT_STORE", "memory")
+CHAT_DB_PATH = os.getenv("CHAT_DB_PATH", "canvasflow.db")
+CHAT_DB_BATCH_SIZE = int(os.getenv("CHAT_DB_BATCH_SIZE", "100"))
+CHAT_DB_FLUSH_INTERVAL = float(os.getenv("CHAT_DB_FLUSH_INTERVAL", "0.05"))
+
+# 图片生成任务注册表：IMAGE_TASK_STORE=memory（默认）或 sqlite（任意worker都能读取任务状态）
+IMAGE_TASK_STORE = os.getenv("IMAGE_TASK_STORE", "memory")
+IMAGE_TASK_DB_PATH = os.getenv("IMAGE_TASK_DB_PATH", CHAT_DB_PATH)
+IMAGE_TASK_TTL = float(os.getenv("IMAGE_TASK_TTL", str(24 * 3600)))
+TASK_REGISTRY_POLL_INTERVAL = float(os.getenv("TASK_REGISTRY_POLL_INTERVAL", "1"))
+
+# 进程内状态清理：会话按空闲时间过期，会话/任务都有条数与内存预算，超出时按LRU淘汰
+STATE_JANITOR_INTERVAL = float(os.getenv("STATE_JANITOR_INTERVAL", "60"))
+CHAT_SESSION_TTL = float(os.getenv("CHAT_SESSION_TTL", str(7 * 24 * 3600)))
+CHAT_MAX_SESSIONS = int(os.getenv("CHAT_MAX_SESSIONS", "10000"))
+CHAT_MAX_BYTES = int(os.getenv("CHAT_MAX_BYTES", str(256 * 1024 * 1024)))
+IMAGE_TASK_MAX_ENTRIES = int(os.getenv("IMAGE_TASK_MAX_ENTRIES", "10000"))
+IMAGE_TASK_MAX_BYTES = int(os.getenv("IMAGE_TASK_MAX_BYTES", str(64 * 1024 * 1024)))
+
+# 对话上下文：历史消息的token预算，超出部分由后台增量摘要
+CHAT_HISTORY_TOKEN_BUDGET = int(os.getenv("CHAT_HISTORY_TOKEN_BUDGET", "6000"))
+CHAT_CONTEXT_MAX_MESSAGES = int(os.getenv("CHAT_CONTEXT_MAX_MESSAGES", "40"))
+CHAT_SUMMARY_MODEL = os.getenv("CHAT_SUMMARY_MODEL", "qwen-turbo")
+CHAT_SUMMARY_BATCH = int(os.getenv("CHAT_SUMMARY_BATCH", "20"))
+CHAT_SUMMARY_WORKERS = int(os.getenv("CHAT_SUMMARY_WORKERS", "2"))
+
+# 聊天SSE合并：攒够N字节或距上一帧超过M毫秒才发送一帧（0表示逐token发送）
+CHAT_STREAM_FLUSH_BYTES = int(os.getenv("CHAT_STREAM_FLUSH_BYTES", "64"))
+CHAT_STREAM_FLUSH_MS = float(os.getenv("CHAT_STREAM_FLUSH_MS", "50"))
+
+# 推测式多样化：聊天回复流出DRAWING_FINAL时提前生成多样化prompts，未被认领的结果超时丢弃
+SPECULATIVE_DIVERSIFY = os.getenv("SPECULATIVE_DIVERSIFY", "1") == "1"
+SPECULATIVE_TTL = float(os.getenv("SPECULATIVE_TTL", "300"))
+# 认领时等待进行中推测的秒数；超时后按SPECULATIVE_ON_TIMEOUT处理：wait继续等待（最多SPECULATIVE_MAX_WAIT秒），discard放弃并重新生成
+SPECULATIVE_WAIT = float(os.getenv("SPECULATIVE_WAIT", "20"))
+SPECULATIVE_ON_TIMEOUT = os.getenv("SPECULATIVE_ON_TIMEOUT", "wait")
+SPECULATIVE_MAX_WAIT = float(os.getenv("SPECULATIVE_MAX_WAIT", "60"))
+SPECULATIVE_MIN_OVERLAP = float(os.getenv("SPECULATIVE_MIN_OVERLAP", "0.8"))
+SPECULATIVE_WORKERS = int(os.getenv("SPECULATIVE_WORKERS", "2"))
+
+# /api/chats 分页
+CHAT_PAGE_SIZE = int(os.getenv("CHAT_PAGE_SIZE", "50"))
+CHAT_PAGE_MAX = int(os.getenv("CHAT_PAGE_MAX", "200"))
+
+# 图片任务状态变化的SSE订阅者 {task_id: [queue.Queue, ...]}
+task_event_subscribers = {}
+task_event_lock = threading.Lock()
+TASK_EVENT_KEEPALIVE = float(os.getenv("TASK_EVENT_KEEPALIVE", "15"))
+
+# 任务版本号变化通知（用于长轮询）
+task_version_cond = threading.Condition()
+TASK_LONG_POLL_MAX = float(os.getenv("TASK_LONG_POLL_MAX", "30"))
 
 # Liblib API配置
 LIBLIB_ACCESS_KEY = os.getenv("LIBLIB_ACCESS_KEY")
@@ -33,6 +103,205 @@ LIBLIB_SECRET_KEY = os.getenv("LIBLIB_SECRET_KEY")
 LIBLIB_API_URL_SUBMIT = "https://openapi.liblibai.cloud/api/generate/webui/text2img"
 LIBLIB_API_URL_QUERY = "https://openapi.liblibai.cloud/api/generate/webui/status"
 
+# Liblib HTTP连接池配置
+LIBLIB_POOL_HOSTS = int(os.getenv("LIBLIB_POOL_HOSTS", "4"))
+LIBLIB_POOL_PER_HOST = int(os.getenv("LIBLIB_POOL_PER_HOST", "20"))
+LIBLIB_CONNECT_TIMEOUT = float(os.getenv("LIBLIB_CONNECT_TIMEOUT", "5"))
+LIBLIB_READ_TIMEOUT = float(os.getenv("LIBLIB_READ_TIMEOUT", "30"))
+LIBLIB_MAX_RETRIES = int(os.getenv("LIBLIB_MAX_RETRIES", "3"))
+LIBLIB_RETRY_BACKOFF = float(os.getenv("LIBLIB_RETRY_BACKOFF", "0.5"))
+
+# Liblib提交限流（令牌桶；配置文件路径后可跨gunicorn worker共享）
+LIBLIB_SUBMIT_RATE = float(os.getenv("LIBLIB_SUBMIT_RATE", "0.5"))
+LIBLIB_SUBMIT_BURST = float(os.getenv("LIBLIB_SUBMIT_BURST", "4"))
+LIBLIB_RATE_LIMIT_FILE = os.getenv("LIBLIB_RATE_LIMIT_FILE", "")
+
+# 图片下载配置
+DOWNLOAD_CHUNK_SIZE = int(os.getenv("DOWNLOAD_CHUNK_SIZE", str(256 * 1024)))
+DOWNLOAD_MAX_BYTES = int(os.getenv("DOWNLOAD_MAX_BYTES", str(30 * 1024 * 1024)))
+DOWNLOAD_MAX_ATTEMPTS = int(os.getenv("DOWNLOAD_MAX_ATTEMPTS", "3"))
+DOWNLOAD_READ_TIMEOUT = float(os.getenv("DOWNLOAD_READ_TIMEOUT", "60"))
+
+# 衍生图片（JPEG/WebP缩略图）配置
+DERIVATIVE_WORKERS = int(os.getenv("DERIVATIVE_WORKERS", "2"))
+DERIVATIVE_TIMEOUT = float(os.getenv("DERIVATIVE_TIMEOUT", "15"))
+# 标记完成前最多等待缩略图的秒数，使网格首次显示即加载缩略图；超时则先以原图完成，缩略图就绪后再推送
+DERIVATIVE_FIRST_PAINT_WAIT = float(os.getenv("DERIVATIVE_FIRST_PAINT_WAIT", "2"))
+THUMBNAIL_SIZE = int(os.getenv("THUMBNAIL_SIZE", "512"))
+WEBP_QUALITY = int(os.getenv("WEBP_QUALITY", "80"))
+
+# 生成图片存储配置（分片目录 + 容量配额）
+IMAGE_STORE_ROOT = os.path.join('static', 'generated_images')
+IMAGE_STORE_QUOTA_BYTES = int(os.getenv("IMAGE_STORE_QUOTA_BYTES", str(2 * 1024 * 1024 * 1024)))
+IMAGE_STORE_COMPACT_INTERVAL = float(os.getenv("IMAGE_STORE_COMPACT_INTERVAL", "300"))
+# 多worker共享同一目录：索引超过该秒数视为过期，写入时先重新扫描磁盘再执行配额
+IMAGE_STORE_RESCAN_INTERVAL = float(os.getenv("IMAGE_STORE_RESCAN_INTERVAL", "30"))
+
+# Liblib状态轮询配置（自适应间隔 + 单任务截止时间）
+LIBLIB_POLL_DEADLINE = float(os.getenv("LIBLIB_POLL_DEADLINE", "180"))
+LIBLIB_POLL_PRIOR = float(os.getenv("LIBLIB_POLL_PRIOR", "30"))
+LIBLIB_POLL_MIN_INTERVAL = float(os.getenv("LIBLIB_POLL_MIN_INTERVAL", "1"))
+LIBLIB_POLL_MAX_INTERVAL = float(os.getenv("LIBLIB_POLL_MAX_INTERVAL", "10"))
+
+# Qwen API配置（连接池与超时）
+QWEN_BASE_URL = "https://dashscope.aliyuncs.com/compatible-mode/v1"
+QWEN_POOL_MAX_CONNECTIONS = int(os.getenv("QWEN_POOL_MAX_CONNECTIONS", "100"))
+QWEN_POOL_MAX_KEEPALIVE = int(os.getenv("QWEN_POOL_MAX_KEEPALIVE", "20"))
+QWEN_KEEPALIVE_EXPIRY = float(os.getenv("QWEN_KEEPALIVE_EXPIRY", "60"))
+QWEN_CONNECT_TIMEOUT = float(os.getenv("QWEN_CONNECT_TIMEOUT", "5"))
+QWEN_READ_TIMEOUT = float(os.getenv("QWEN_READ_TIMEOUT", "120"))
+QWEN_POOL_TIMEOUT = float(os.getenv("QWEN_POOL_TIMEOUT", "10"))
+QWEN_MAX_RETRIES = int(os.getenv("QWEN_MAX_RETRIES", "2"))
+
+class LiblibHttpPool:
+    """Shared keep-alive requests session for Liblib API and CDN traffic"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._session = None
+        self.requests = 0
+        self.errors = 0
+
+    def _build_session(self):
+        # POST提交不是幂等的，只对连接错误重试；GET下载和状态码错误才做完整重试
+        retry = Retry(
+            total=LIBLIB_MAX_RETRIES,
+            connect=LIBLIB_MAX_RETRIES,
+            read=LIBLIB_MAX_RETRIES,
+            status=LIBLIB_MAX_RETRIES,
+            backoff_factor=LIBLIB_RETRY_BACKOFF,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset(['GET', 'HEAD']),
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(
+            pool_connections=LIBLIB_POOL_HOSTS,
+            pool_maxsize=LIBLIB_POOL_PER_HOST,
+            pool_block=True,
+            max_retries=retry
+        )
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    @property
+    def session(self):
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    self._session = self._build_session()
+        return self._session
+
+    def request(self, method, url, **kwargs):
+        """Send a request through the pool with explicit connect/read timeouts"""
+        kwargs.setdefault('timeout', (LIBLIB_CONNECT_TIMEOUT, LIBLIB_READ_TIMEOUT))
+        with self._lock:
+            self.requests += 1
+        try:
+            return self.session.request(method, url, **kwargs)
+        except Exception:
+            with self._lock:
+                self.errors += 1
+            raise
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def stats(self):
+        """Request counters and pool limits"""
+        with self._lock:
+            return {
+                'initialized': self._session is not None,
+                'requests': self.requests,
+                'errors': self.errors,
+                'pool_per_host': LIBLIB_POOL_PER_HOST,
+                'connect_timeout': LIBLIB_CONNECT_TIMEOUT,
+                'read_timeout': LIBLIB_READ_TIMEOUT
+            }
+
+liblib_http = LiblibHttpPool()
+
+class TokenBucket:
+    """
+    Token bucket rate limiter
+    
+    With a state_path the bucket state lives in a file guarded by flock, so
+    every process on the host (e.g. all gunicorn workers) shares one budget.
+    Otherwise the bucket is process-local.
+    """
+
+    def __init__(self, rate, burst, state_path=None):
+        self.rate = rate
+        self.burst = burst
+        self.state_path = state_path if (state_path and fcntl) else None
+        self._lock = threading.Lock()
+        self._tokens = burst
+        self._updated = time.time()
+        self.acquired = 0
+        self.waited = 0.0
+
+    def _take(self, now, tokens, updated):
+        """Refill and try to take one token; returns (wait, tokens, updated)"""
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens >= 1:
+            return 0.0, tokens - 1, now
+        return (1 - tokens) / self.rate, tokens, now
+
+    def _try_acquire_shared(self, now):
+        with open(self.state_path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                raw = f.read().split()
+                tokens, updated = (float(raw[0]), float(raw[1])) if len(raw) == 2 else (self.burst, now)
+                wait, tokens, updated = self._take(now, tokens, updated)
+                f.seek(0)
+                f.truncate()
+                f.write(f"{tokens} {updated}")
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        return wait
+
+    def _try_acquire_local(self, now):
+        wait, self._tokens, self._updated = self._take(now, self._tokens, self._updated)
+        return wait
+
+    def acquire(self):
+        """Block until a token is available"""
+        if self.rate <= 0:
+            return
+        started = time.time()
+        while True:
+            with self._lock:
+                now = time.time()
+                if self.state_path:
+                    wait = self._try_acquire_shared(now)
+                else:
+                    wait = self._try_acquire_local(now)
+                if wait <= 0:
+                    self.acquired += 1
+                    self.waited += now - started
+                    return
+            time.sleep(wait)
+
+    def stats(self):
+        """Limiter configuration and counters"""
+        with self._lock:
+            return {
+                'rate': self.rate,
+                'burst': self.burst,
+                'shared': self.state_path is not None,
+                'acquired': self.acquired,
+                'total_wait': round(self.waited, 3)
+            }
+
+liblib_submit_limiter = TokenBucket(LIBLIB_SUBMIT_RATE, LIBLIB_SUBMIT_BURST, LIBLIB_RATE_LIMIT_FILE)
+
 def generate_liblib_signature(uri, secret_key):
     """Generate signature required for Liblib API calls"""
     timestamp = str(int(time.time() * 1000))
@@ -42,11 +311,8 @@ def generate_liblib_signature(uri, secret_key):
     sign = base64.urlsafe_b64encode(digest).rstrip(b'=').decode()
     return {"signature": sign, "timestamp": timestamp, "signature_nonce": nonce}
 
-def submit_liblib_image_task(prompt, options=None):
-    """Submit image generation task to Liblib"""
-    # Debug log
-    logger.info(f"Submitting LibLib task, prompt: {prompt}")
-    
+def build_liblib_request(prompt, options=None):
+    """Build the text2img request body for a prompt"""
     # Default parameters
     default_params = {
         "templateUuid": "6f7c4652458d4802969f8d089cf5b91f",
@@ -67,6 +333,21 @@ def submit_liblib_image_task(prompt, options=None):
     # If there are custom parameters, merge them into default parameters
     if options:
         default_params["generateParams"].update(options)
+    return default_params
+
+def liblib_profile_key(generate_params):
+    """Key used to learn typical generation time (checkpoint + size)"""
+    return f"{generate_params.get('checkPointId')}:{generate_params.get('width')}x{generate_params.get('height')}"
+
+def submit_liblib_image_task(prompt, options=None):
+    """Submit image generation task to Liblib"""
+    # Debug log
+    logger.info(f"Submitting LibLib task, prompt: {prompt}")
+    
+    default_params = build_liblib_request(prompt, options)
+    
+    # 全局限流：空闲时立即提交，繁忙时平滑所有任务的提交
+    liblib_submit_limiter.acquire()
     
     # Generate API signature
     uri = "/api/generate/webui/text2img"
@@ -79,7 +360,7 @@ def submit_liblib_image_task(prompt, options=None):
     # Send request
     headers = {"Content-Type": "application/json"}
     try:
-        resp = requests.post(url, headers=headers, data=json.dumps(default_params))
+        resp = liblib_http.post(url, headers=headers, data=json.dumps(default_params))
         if resp.status_code == 200:
             data = resp.json()
             if data.get("code") == 0:
@@ -93,95 +374,1003 @@ def submit_liblib_image_task(prompt, options=None):
     
     return None
 
-def get_liblib_image_result(uuid_, max_wait_time=180, interval=5):
-    """Get Liblib image generation results"""
+def query_liblib_image_status(uuid_):
+    """
+    Query Liblib once for the status of a generation
+    
+    Returns:
+        Tuple (state, value): ('completed', image_url), ('failed', reason) or ('pending', generate_status)
+    """
     uri = "/api/generate/webui/status"
+    
+    # Generate signature
+    sign = generate_liblib_signature(uri, LIBLIB_SECRET_KEY)
+    params = f"?AccessKey={LIBLIB_ACCESS_KEY}&Signature={sign['signature']}&Timestamp={sign['timestamp']}&SignatureNonce={sign['signature_nonce']}"
+    url = LIBLIB_API_URL_QUERY + params
+    
+    # Send request
+    headers = {"Content-Type": "application/json"}
+    try:
+        resp = liblib_http.post(url, headers=headers, json={"generateUuid": uuid_})
+        if resp.status_code == 200:
+            result = resp.json()
+            if result.get("code") == 0:
+                status = result["data"]["generateStatus"]
+                images = result["data"].get("images", [])
+                
+                if images and images[0].get("auditStatus") == 3:
+                    return 'completed', images[0]["imageUrl"]
+                elif images:
+                    logger.warning("Image failed review")
+                    return 'failed', 'Image failed review'
+                elif status in [4, 5]:
+                    logger.error("Generation failed or blocked")
+                    return 'failed', 'Generation failed'
+                else:
+                    logger.info(f"Image generating...status: {status}")
+                    return 'pending', status
+        else:
+            logger.error(f"Liblib HTTP error: {resp.status_code}")
+    except Exception as e:
+        logger.error(f"Liblib request exception: {e}")
+    
+    return 'pending', None
+
+def get_liblib_image_result(uuid_, max_wait_time=180, interval=5):
+    """Get Liblib image generation results (blocking; the app uses liblib_poller instead)"""
     start_time = time.time()
     
     while time.time() - start_time < max_wait_time:
-        # Generate signature
-        sign = generate_liblib_signature(uri, LIBLIB_SECRET_KEY)
-        params = f"?AccessKey={LIBLIB_ACCESS_KEY}&Signature={sign['signature']}&Timestamp={sign['timestamp']}&SignatureNonce={sign['signature_nonce']}"
-        url = LIBLIB_API_URL_QUERY + params
-        
-        # Send request
-        headers = {"Content-Type": "application/json"}
+        state, value = query_liblib_image_status(uuid_)
+        if state == 'completed':
+            return value
+        if state == 'failed':
+            return None
+        time.sleep(interval)
+    
+    logger.error("Image generation timeout")
+    return None
+
+class AdaptivePollSchedule:
+    """
+    Learns typical generation time per checkpoint/size and spaces polls around it
+    
+    Polls are sparse while the job is far from its expected completion time,
+    dense around it, and back off gradually once the job is overdue. Every
+    interval is clipped to the task's remaining deadline.
+    """
+
+    def __init__(self, prior=30.0, min_interval=1.0, max_interval=10.0, alpha=0.3):
+        self.prior = prior
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.alpha = alpha
+        self._lock = threading.Lock()
+        self._profiles = {}
+        self.completed = 0
+        self.total_polls = 0
+
+    def expected(self, key):
+        """Expected generation time in seconds for a profile key"""
+        with self._lock:
+            profile = self._profiles.get(key)
+            return profile['expected'] if profile else self.prior
+
+    def next_interval(self, key, elapsed, remaining):
+        """Seconds to wait before the next poll"""
+        expected = self.expected(key)
+        if elapsed < expected * 0.8:
+            # 离预计完成时间较远：一次性睡到预计时间附近
+            interval = expected * 0.8 - elapsed
+        elif elapsed < expected * 1.2:
+            interval = self.min_interval
+        else:
+            # 超出预期后逐步退避
+            interval = (elapsed - expected) * 0.25
+        interval = max(self.min_interval, min(self.max_interval, interval))
+        return max(0.0, min(interval, remaining))
+
+    def record(self, key, duration, polls):
+        """Learn from a completed generation"""
+        with self._lock:
+            profile = self._profiles.get(key)
+            if profile is None:
+                self._profiles[key] = {'expected': duration, 'samples': 1}
+            else:
+                profile['expected'] += self.alpha * (duration - profile['expected'])
+                profile['samples'] += 1
+            self.completed += 1
+            self.total_polls += polls
+
+    def stats(self):
+        """Learned profiles and average polls per completed image"""
+        with self._lock:
+            return {
+                'profiles': {
+                    key: {'expected': round(p['expected'], 2), 'samples': p['samples']}
+                    for key, p in self._profiles.items()
+                },
+                'completed': self.completed,
+                'avg_polls_per_image': round(self.total_polls / self.completed, 2) if self.completed else None
+            }
+
+class LiblibPoller:
+    """
+    Single asyncio event loop that polls every outstanding Liblib generation
+    
+    The loop runs on one daemon thread; blocking HTTP calls and downloads are
+    handed to a fixed-size executor, so the number of threads does not grow
+    with the number of in-flight images.
+    """
+
+    def __init__(self, workers=4):
+        self._workers = workers
+        self._lock = threading.Lock()
+        self._loop = None
+        self._thread = None
+        self._executor = None
+        self._outstanding = {}
+        self.polls = 0
+        self.cancelled = 0
+
+    def _ensure_started(self):
+        if self._loop is not None:
+            return
+        with self._lock:
+            if self._loop is not None:
+                return
+            loop = asyncio.new_event_loop()
+            self._executor = ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix='liblib-poll')
+            self._thread = Thread(target=self._run, args=(loop,), name='liblib-poller', daemon=True)
+            self._thread.start()
+            self._loop = loop
+
+    def _run(self, loop):
+        asyncio.set_event_loop(loop)
+        loop.run_forever()
+
+    def track(self, uuid_, task_id, image_index, profile_key=None, max_wait_time=None, cache_key=None):
+        """Start polling a submitted generation; results are written into task_registry"""
+        if max_wait_time is None:
+            max_wait_time = LIBLIB_POLL_DEADLINE
+        self._ensure_started()
+        with self._lock:
+            self._outstanding[uuid_] = {'task_id': task_id, 'image_index': image_index, 'started': time.time()}
+        asyncio.run_coroutine_threadsafe(
+            self._poll(uuid_, task_id, image_index, profile_key, max_wait_time, cache_key), self._loop
+        )
+
+    async def _poll(self, uuid_, task_id, image_index, profile_key, max_wait_time, cache_key):
+        loop = asyncio.get_running_loop()
+        started = time.time()
+        deadline = started + max_wait_time
+        polls = 0
         try:
-            resp = requests.post(url, headers=headers, json={"generateUuid": uuid_})
-            if resp.status_code == 200:
-                result = resp.json()
-                if result.get("code") == 0:
-                    status = result["data"]["generateStatus"]
-                    images = result["data"].get("images", [])
+            while True:
+                now = time.time()
+                if now >= deadline:
+                    break
+                await asyncio.sleep(liblib_poll_schedule.next_interval(profile_key, now - started, deadline - now))
+                # 任务已取消（或会话已删除）时停止轮询
+                if is_task_cancelled(task_id):
+                    with self._lock:
+                        self.cancelled += 1
+                    return
+                polls += 1
+                with self._lock:
+                    self.polls += 1
+                state, value = await loop.run_in_executor(self._executor, query_liblib_image_status, uuid_)
+                if state == 'completed':
+                    liblib_poll_schedule.record(profile_key, time.time() - started, polls)
+                    update_image_state(task_id, image_index, polls=polls)
+                    # 生成完成只需把URL交给下载阶段
+                    download_pipeline.submit(task_id, image_index, value, cache_key)
+                    return
+                if state == 'failed':
+                    update_image_state(task_id, image_index, status='failed', error=value, polls=polls)
+                    return
+            logger.error("Image generation timeout")
+            update_image_state(task_id, image_index, status='failed', error='Generation failed', polls=polls)
+        except Exception as e:
+            logger.error(f"Error polling image generation: {e}")
+            update_image_state(task_id, image_index, status='failed', error=str(e), polls=polls)
+        finally:
+            with self._lock:
+                self._outstanding.pop(uuid_, None)
+
+    def stats(self):
+        """Outstanding generations and poll counters"""
+        with self._lock:
+            return {
+                'running': self._loop is not None,
+                'outstanding': len(self._outstanding),
+                'polls': self.polls,
+                'cancelled': self.cancelled,
+                'workers': self._workers
+            }
+
+liblib_poll_schedule = AdaptivePollSchedule(
+    prior=LIBLIB_POLL_PRIOR,
+    min_interval=LIBLIB_POLL_MIN_INTERVAL,
+    max_interval=LIBLIB_POLL_MAX_INTERVAL
+)
+liblib_poller = LiblibPoller(workers=int(os.getenv("LIBLIB_POLLER_WORKERS", "4")))
+
+class DownloadTooLarge(Exception):
+    """Raised when an image exceeds DOWNLOAD_MAX_BYTES"""
+
+def iter_download_chunks(response):
+    """Yield body chunks as they arrive so a broken transfer keeps what was received"""
+    raw = response.raw
+    if hasattr(raw, 'read1'):
+        while True:
+            chunk = raw.read1(DOWNLOAD_CHUNK_SIZE, decode_content=True)
+            if not chunk:
+                break
+            yield chunk
+    else:
+        yield from response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE)
+
+def download_image(image_url, save_path):
+    """
+    Download image to local storage
+    
+    Streams into a temporary file with a running SHA-256, resumes with a
+    Range request (or restarts) after a partial transfer, and atomically
+    renames the file into place once complete.
+    
+    Returns:
+        Dict with bytes, sha256 and seconds on success, None on failure
+    """
+    tmp_path = f"{save_path}.{uuid.uuid4().hex}.part"
+    started = time.time()
+    try:
+        # Ensure directory exists
+        os.makedirs(os.path.dirname(save_path), exist_ok=True)
+        
+        digest = hashlib.sha256()
+        received = 0
+        expected = None
+        with open(tmp_path, 'wb') as f:
+            for attempt in range(DOWNLOAD_MAX_ATTEMPTS):
+                headers = {'Range': f'bytes={received}-'} if received else {}
+                try:
+                    # 使用with确保流式响应结束后连接归还连接池
+                    with liblib_http.get(image_url, stream=True, headers=headers,
+                                         timeout=(LIBLIB_CONNECT_TIMEOUT, DOWNLOAD_READ_TIMEOUT)) as response:
+                        response.raise_for_status()
+                        if received and response.status_code != 206:
+                            # 服务器不支持断点续传：从头开始
+                            f.seek(0)
+                            f.truncate()
+                            digest = hashlib.sha256()
+                            received = 0
+                        length = response.headers.get('Content-Length')
+                        if length is not None:
+                            expected = received + int(length)
+                            if expected > DOWNLOAD_MAX_BYTES:
+                                raise DownloadTooLarge(f"Image too large: {expected} bytes")
+                        
+                        for chunk in iter_download_chunks(response):
+                            received += len(chunk)
+                            if received > DOWNLOAD_MAX_BYTES:
+                                raise DownloadTooLarge(f"Image exceeds {DOWNLOAD_MAX_BYTES} bytes")
+                            digest.update(chunk)
+                            f.write(chunk)
                     
-                    if images and images[0].get("auditStatus") == 3:
-                        return images[0]["imageUrl"]
-                    elif images:
-                        logger.warning("Image failed review")
-                        return None
-                    elif status in [4, 5]:
-                        logger.error("Generation failed or blocked")
-                        return None
-                    else:
-                        logger.info(f"Image generating...status: {status}")
+                    if expected is not None and received < expected:
+                        raise requests.exceptions.ChunkedEncodingError(
+                            f"Partial transfer: {received}/{expected} bytes"
+                        )
+                    break
+                except DownloadTooLarge:
+                    raise
+                except (requests.exceptions.ConnectionError,
+                        requests.exceptions.ChunkedEncodingError,
+                        requests.exceptions.Timeout,
+                        urllib3.exceptions.HTTPError) as e:
+                    if attempt == DOWNLOAD_MAX_ATTEMPTS - 1:
+                        raise
+                    logger.warning(f"Image download interrupted at {received} bytes, retrying: {e}")
+                    time.sleep(LIBLIB_RETRY_BACKOFF * (2 ** attempt))
+        
+        os.replace(tmp_path, save_path)
+        seconds = time.time() - started
+        logger.info(f"Image download successful: {save_path}")
+        return {'bytes': received, 'sha256': digest.hexdigest(), 'seconds': seconds}
+    except Exception as e:
+        logger.error(f"Image download failed: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return None
+
+class DownloadPipeline:
+    """
+    Download stage with its own concurrency limit
+    
+    The poller only hands finished image URLs to this stage, so slow CDN
+    responses never hold polling capacity.
+    """
+
+    def __init__(self, workers=4):
+        self.workers = workers
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='image-download')
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.active = 0
+        self.completed = 0
+        self.failed = 0
+        self.skipped = 0
+        self.bytes_total = 0
+        self.avg_throughput = None
+
+    def submit(self, task_id, image_index, image_url, cache_key=None):
+        """Queue a finished image for download"""
+        with self._lock:
+            self.queued += 1
+        self._executor.submit(self._run, task_id, image_index, image_url, cache_key)
+
+    def _run(self, task_id, image_index, image_url, cache_key):
+        with self._lock:
+            self.queued -= 1
+        if is_task_cancelled(task_id):
+            with self._lock:
+                self.skipped += 1
+            return
+        with self._lock:
+            self.active += 1
+        try:
+            finish_generated_image(task_id, image_index, image_url, cache_key)
+        except Exception as e:
+            logger.error(f"Error finishing image: {e}")
+            update_image_state(task_id, image_index, status='failed', error=str(e))
+        finally:
+            with self._lock:
+                self.active -= 1
+
+    def record(self, result):
+        """Record the outcome of one download"""
+        with self._lock:
+            if result is None:
+                self.failed += 1
+                return
+            self.completed += 1
+            self.bytes_total += result['bytes']
+            throughput = result['bytes'] / max(result['seconds'], 1e-6)
+            if self.avg_throughput is None:
+                self.avg_throughput = throughput
             else:
-                logger.error(f"Liblib HTTP error: {resp.status_code}")
+                self.avg_throughput += 0.2 * (throughput - self.avg_throughput)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'queued': self.queued,
+                'active': self.active,
+                'completed': self.completed,
+                'failed': self.failed,
+                'skipped': self.skipped,
+                'bytes_total': self.bytes_total,
+                'avg_throughput_bps': round(self.avg_throughput) if self.avg_throughput else None
+            }
+
+download_pipeline = DownloadPipeline(workers=int(os.getenv("DOWNLOAD_WORKERS", "4")))
+
+def static_url(path):
+    """URL of a file stored under the static folder"""
+    return '/' + os.path.relpath(path).replace(os.sep, '/')
+
+class DerivativePipeline:
+    """Encodes JPEG and WebP grid thumbnails on a process pool, off the request and download threads"""
+
+    def __init__(self, workers=2):
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._pool = None
+        self.completed = 0
+        self.failed = 0
+        self.avg_seconds = None
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                # spawn避免在多线程进程中fork
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('spawn')
+                )
+            return self._pool
+
+    def submit(self, save_path):
+        """Start encoding variants for a downloaded image; returns a future, or None when disabled"""
+        if image_derivatives.Image is None:
+            return None
+        try:
+            future = self._get_pool().submit(
+                image_derivatives.make_image_derivatives, save_path, THUMBNAIL_SIZE, WEBP_QUALITY
+            )
+        except BrokenProcessPool as e:
+            logger.error(f"Derivative worker pool broken, recreating: {e}")
+            with self._lock:
+                self._pool = None
+                self.failed += 1
+            return None
+        future.started = time.time()
+        return future
+
+    def result(self, future, timeout):
+        """
+        Variant paths {name: path} of a submit() future, or None if encoding failed
+        
+        Raises FutureTimeoutError if the variants are still being encoded
+        after timeout seconds; the future can be waited on again.
+        """
+        try:
+            variants = future.result(timeout=timeout)
+        except FutureTimeoutError:
+            raise
+        except BrokenProcessPool as e:
+            logger.error(f"Derivative worker pool broken, recreating: {e}")
+            with self._lock:
+                self._pool = None
+                self.failed += 1
+            return None
         except Exception as e:
-            logger.error(f"Liblib request exception: {e}")
-            
-        time.sleep(interval)
+            logger.error(f"Failed to create image derivatives: {e}")
+            with self._lock:
+                self.failed += 1
+            return None
+        
+        seconds = time.time() - future.started
+        with self._lock:
+            self.completed += 1
+            self.avg_seconds = seconds if self.avg_seconds is None else self.avg_seconds + 0.2 * (seconds - self.avg_seconds)
+        return variants
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': image_derivatives.Image is not None,
+                'workers': self.workers,
+                'completed': self.completed,
+                'failed': self.failed,
+                'avg_seconds': round(self.avg_seconds, 3) if self.avg_seconds else None
+            }
+
+derivative_pipeline = DerivativePipeline(workers=DERIVATIVE_WORKERS)
+
+class ImageStore:
+    """
+    Hash-sharded on-disk store for generated images with a byte quota
     
-    logger.error("Image generation timeout")
-    return None
+    Files live in <root>/<xx>/<yy>/ directories derived from a hash of the
+    filename. An image and its derivatives form one entry; when the store
+    exceeds its quota the least recently accessed entries are deleted. A
+    background pass periodically rescans the disk, enforces the quota and
+    marks task images whose files are gone.
+    
+    Several workers may share the directory, so the disk is the source of
+    truth: the index is rescanned before evicting or once it is older than
+    rescan_interval, and accesses are recorded in file mtimes so every
+    worker sees the same LRU order.
+    """
+
+    def __init__(self, root, quota_bytes, compact_interval=300, rescan_interval=30):
+        self.root = root
+        self.quota_bytes = quota_bytes
+        self.compact_interval = compact_interval
+        self.rescan_interval = rescan_interval
+        self._lock = threading.RLock()
+        self._entries = None
+        self._bytes = 0
+        self._scanned_at = 0
+        self._compactor = None
+        self.evictions = 0
+        self.evicted_bytes = 0
+
+    @staticmethod
+    def _stem(path):
+        stem = os.path.splitext(path)[0]
+        return stem[:-len('_thumb')] if stem.endswith('_thumb') else stem
+
+    def path_for(self, filename):
+        """Sharded path for a new file"""
+        digest = hashlib.sha1(filename.encode()).hexdigest()
+        directory = os.path.join(self.root, digest[:2], digest[2:4])
+        os.makedirs(directory, exist_ok=True)
+        return os.path.join(directory, filename)
+
+    def _scan(self):
+        """Rebuild the index from disk; must be called with the lock held"""
+        entries = {}
+        total = 0
+        now = time.time()
+        for directory, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                path = os.path.join(directory, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                if filename.endswith('.part'):
+                    # 清理中断下载/编码遗留的临时文件（其他worker可能已删除）
+                    if now - stat.st_mtime > 3600:
+                        try:
+                            os.remove(path)
+                        except OSError:
+                            pass
+                    continue
+                stem = self._stem(path)
+                previous = (self._entries or {}).get(stem)
+                entry = entries.setdefault(stem, {
+                    'paths': set(),
+                    'bytes': 0,
+                    'atime': max(stat.st_atime, stat.st_mtime, previous['atime'] if previous else 0)
+                })
+                entry['paths'].add(path)
+                entry['bytes'] += stat.st_size
+                total += stat.st_size
+        self._entries = entries
+        self._bytes = total
+        self._scanned_at = time.time()
+
+    def _ensure_index(self):
+        if self._entries is None:
+            with self._lock:
+                if self._entries is None:
+                    self._scan()
+        if self._compactor is None and self.compact_interval > 0:
+            with self._lock:
+                if self._compactor is None:
+                    self._compactor = Thread(target=self._compact_loop, name='image-store-compactor', daemon=True)
+                    self._compactor.start()
+
+    def add(self, *paths):
+        """Register a stored image and its derivatives, then enforce the quota"""
+        self._ensure_index()
+        with self._lock:
+            for path in paths:
+                try:
+                    size = os.path.getsize(path)
+                except OSError:
+                    continue
+                entry = self._entries.setdefault(self._stem(path), {'paths': set(), 'bytes': 0, 'atime': time.time()})
+                if path not in entry['paths']:
+                    entry['paths'].add(path)
+                    entry['bytes'] += size
+                    self._bytes += size
+                entry['atime'] = time.time()
+        self.enforce_quota()
+
+    def touch(self, path):
+        """Record an access to a stored file"""
+        try:
+            # 写入mtime，其他worker重新扫描时也能看到这次访问
+            os.utime(path)
+        except OSError:
+            pass
+        if self._entries is None:
+            return
+        with self._lock:
+            entry = self._entries.get(self._stem(path))
+            if entry is not None:
+                entry['atime'] = time.time()
+
+    def enforce_quota(self, rescan=True):
+        """Evict least recently accessed entries until under quota; returns evicted paths"""
+        evicted = []
+        with self._lock:
+            # 其他worker写入的文件不在本进程索引中，淘汰前以磁盘为准
+            if rescan and (self._bytes > self.quota_bytes or time.time() - self._scanned_at > self.rescan_interval):
+                self._scan()
+            if self._bytes <= self.quota_bytes:
+                return evicted
+            # 淘汰到配额的90%，避免每次写入都触发淘汰
+            target = self.quota_bytes * 0.9
+            for stem, entry in sorted(self._entries.items(), key=lambda item: item[1]['atime']):
+                if self._bytes <= target:
+                    break
+                for path in entry['paths']:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                    evicted.append(path)
+                del self._entries[stem]
+                self._bytes -= entry['bytes']
+                self.evictions += 1
+                self.evicted_bytes += entry['bytes']
+        if evicted:
+            logger.info(f"Image store evicted {len(evicted)} files to stay under quota")
+            self.reconcile_tasks(evicted)
+        return evicted
+
+    def reconcile_tasks(self, evicted=None):
+        """Mark completed task images whose files were evicted, or are missing from disk if evicted is None"""
+        evicted = set(evicted) if evicted is not None else None
+        for task_id in task_registry.task_ids():
+            task = task_registry.peek(task_id)
+            if task is None:
+                continue
+            for image_index, image in enumerate(task['images']):
+                url = image.get('url')
+                if image.get('status') != 'completed' or not url:
+                    continue
+                path = url.lstrip('/')
+                # 任务可能属于其他worker，只能依据淘汰列表或磁盘判断，不能依据本进程索引
+                if (path in evicted) if evicted is not None else not os.path.exists(path):
+                    update_image_state(
+                        task_id, image_index,
+                        status='failed', url=None, variants=None,
+                        error='Image evicted from storage'
+                    )
+
+    def compact(self):
+        """Rescan disk, enforce the quota and reconcile task state"""
+        with self._lock:
+            self._scan()
+        self.enforce_quota(rescan=False)
+        self.reconcile_tasks()
+
+    def _compact_loop(self):
+        while True:
+            time.sleep(self.compact_interval)
+            try:
+                self.compact()
+            except Exception as e:
+                logger.error(f"Image store compaction failed: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries) if self._entries is not None else None,
+                'bytes': self._bytes,
+                'quota_bytes': self.quota_bytes,
+                'evictions': self.evictions,
+                'evicted_bytes': self.evicted_bytes
+            }
+
+image_store = ImageStore(
+    IMAGE_STORE_ROOT, IMAGE_STORE_QUOTA_BYTES, IMAGE_STORE_COMPACT_INTERVAL, IMAGE_STORE_RESCAN_INTERVAL
+)
+
+class LRUCache:
+    """Thread-safe LRU cache with per-entry TTL and hit/miss counters"""
+
+    def __init__(self, maxsize=256, ttl=3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] < time.time():
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.time() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+prompt_cache = LRUCache(
+    maxsize=int(os.getenv("PROMPT_CACHE_SIZE", "256")),
+    ttl=float(os.getenv("PROMPT_CACHE_TTL", "3600"))
+)
+
+def prompt_cache_key(base_prompt, is_meta_prompt):
+    """Cache key for diversified prompts: normalized base prompt plus meta/simple mode"""
+    normalized = ' '.join(base_prompt.split())
+    mode = 'meta' if is_meta_prompt else 'simple'
+    return hashlib.sha256(f"{mode}\n{normalized}".encode()).hexdigest()
+
+def estimate_tokens(text):
+    """Approximate token count: one per CJK character, about four characters per token otherwise"""
+    cjk = sum(1 for ch in text if '\u2e80' <= ch <= '\u9fff' or '\uac00' <= ch <= '\ud7af')
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+class PromptTemplate:
+    """A registered system prompt with its version id and token count"""
+
+    def __init__(self, name, content):
+        self.name = name
+        self.content = content
+        # 版本号由内容哈希得出，提示词改动后自动变化
+        self.version = f"{name}@{hashlib.sha256(content.encode()).hexdigest()[:10]}"
+        self.tokens = estimate_tokens(content)
+        self.calls = 0
+        self.latency = 0.0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+
+class PromptRegistry:
+    """
+    System prompts loaded once at startup
+    
+    messages() always puts the template's exact text first, so every
+    request for a template shares a byte-identical prefix that the
+    provider can cache. record() attributes latency and reported prompt
+    and cached token usage to the template version.
+    """
+
+    def __init__(self):
+        self._templates = {}
+        self._lock = threading.Lock()
+
+    def register(self, name, content):
+        template = PromptTemplate(name, content)
+        self._templates[name] = template
+        logger.info(f"Registered prompt template {template.version} (~{template.tokens} tokens)")
+        return template
+
+    def get(self, name):
+        return self._templates[name]
+
+    def messages(self, name, *rest):
+        """System message for the template followed by rest"""
+        return [{'role': 'system', 'content': self._templates[name].content}, *rest]
+
+    def record(self, name, seconds, usage=None):
+        """Attribute one completed call (latency, usage if reported) to the template"""
+        template = self._templates[name]
+        details = getattr(usage, 'prompt_tokens_details', None)
+        with self._lock:
+            template.calls += 1
+            template.latency += seconds
+            template.prompt_tokens += getattr(usage, 'prompt_tokens', None) or 0
+            template.cached_tokens += getattr(details, 'cached_tokens', None) or 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                template.name: {
+                    'version': template.version,
+                    'tokens': template.tokens,
+                    'calls': template.calls,
+                    'avg_latency_ms': round(template.latency / template.calls * 1000, 1) if template.calls else 0,
+                    'prompt_tokens': template.prompt_tokens,
+                    'cached_tokens': template.cached_tokens
+                }
+                for template in self._templates.values()
+            }
+
+CHAT_SYSTEM_PROMPT = '''⚠️ **Important Reminder: Only ask ONE question per reply! Absolutely no multiple questions at once!**
+
+You are a professional AI drawing assistant. Your tasks are:
+1. Understand what users want to create through natural, progressive conversation (ask only one question at a time)
+2. Intelligently generate relevant follow-up questions based on user's specific choices (ask only one question at a time)
+3. Be ready to start drawing based on available information at any time
+4. Analyze definite requirements and variable requirements, generate intelligent meta prompts
+
+## 🎨 **Conversation Strategy**
+
+### **🚨 Core Principle: Only ask one question at a time**
+
+**⚠️ Absolutely forbidden to ask multiple questions in one reply!**
+
+- **One dimension at a time**: Each reply can only ask about one dimension choice, cannot ask about style + composition + color simultaneously
+- **One DRAWING_OPTIONS at a time**: Each reply can contain at most one DRAWING_OPTIONS block
+- **Progressive conversation**: Wait for user to choose this question, then ask the next question in the next round
+- **Natural guidance**: First show interest in user's ideas, then naturally guide to a specific question
+- **Avoid greediness**: Don't try to collect all information at once, be patient and go step by step
+
+**❌ Wrong Example:**
+```
+What style do you want?
+DRAWING_OPTIONS:Realistic|Anime|Oil Painting|Watercolor
+
+What composition do you prefer?
+DRAWING_OPTIONS:Close-up|Full Body|Environmental|Dynamic
+```
+
+**✅ Correct Example:**
+```
+What style do you want?
+DRAWING_OPTIONS:Realistic|Anime|Oil Painting|Watercolor
+```
+Wait for user to choose, then ask about composition in the next round.
+
+### **Dynamic Question Strategy**
+
+**Core Idea: Generate relevant questions based on user's specific expressions**
+
+**Example 1 - If user says "I want to draw a cute kitten":**
+- Don't directly ask "What style do you prefer?"
+- Should respond naturally then provide options:
+```
+Kittens are so cute! What kind of feeling do you want to create?
+
+DRAWING_OPTIONS:Fluffy Realistic - High-definition photographic level real kitten, detailed fur texture, warm natural lighting|Adorable Cartoon - Cute anime style kitten, big eyes and round face, vibrant colors|Elegant Oil Painting - Classical painting style elegant kitten, thick brushstrokes, artistic atmosphere|Fresh Watercolor - Transparent watercolor effect kitten, soft colors, beautiful mood
+```
+
+**Example 2 - If user chose "Anime Illustration" style:**
+- Continue deeper based on anime characteristics
+```
+Since you like anime illustration style, for the kitten's expression, which anime feeling do you prefer?
+
+DRAWING_OPTIONS:Fresh Daily Life - Warm daily feeling like Miyazaki films, fresh natural colors|Dreamy Girl - Sweet and cute shoujo manga style, dreamy bubbles and flower elements|Healing Cute Pet - Adorable style like Totoro and Pikachu that makes people happy|Simple Lines - Clean and simple lines and color blocks, modern anime's minimalist beauty
+```
+
+**Example 3 - If user chose "Realistic Photography":**
+- Focus on photography and kitten specific combination
+```
+Realistic photography of a kitten must be very charming! What kind of photography feeling do you prefer?
+
+DRAWING_OPTIONS:Natural Lighting - Sunlight through windows shining on the kitten, warm home environment|Professional Studio - Perfect lighting setup, highlighting kitten's fur texture and eyes|Outdoor Portrait - Kitten's natural state in garden or grass|Artistic Portrait - Creative composition and lighting, showing kitten's elegant temperament
+```
+
+### **🚨 重要：DRAWING_OPTIONS格式要求**
+- 必须使用DRAWING_OPTIONS:开头
+- 选项之间用|分隔（这点非常重要！）
+- 每个选项包含名称和描述，用-分隔
+- 前面要有自然的引导性文字
+- **每个回复最多只能有一个DRAWING_OPTIONS块！**
+- **绝对不能在一个回复中问多个问题！**
+
+### **何时提供选择选项**
+除以下情况外，**每次回复都必须包含DRAWING_OPTIONS**：
+- 用户明确说"开始绘画"、"开始画"等
+- 用户已经提供了足够信息且主动建议开始绘画
+- 用户表达不耐烦想直接开始
+
+**典型需要提供选项的情况：**
+- 用户刚说想画什么（如"我想画小猫"）
+- 用户选择了一个选项，需要进一步细化
+- 对话还在探索和确定需求阶段
+
+### **智能判断何时深入**
+- 根据用户当前的信息量判断是否需要继续询问
+- 如果用户表达已经比较完整，主动建议开始绘画
+- 避免无意义的重复询问
+
+### **🚨 关键流程控制**
+
+**流程分为两个阶段：**
+
+**阶段1 - 确认选择（生成总结）：**
+当用户发送"我确认选择：XXX。请根据我之前的所有选择，生成一个完整详细的绘画提示词描述，并提供开始绘画的选项。"时：
+- 生成完整的meta prompt总结
+- 在最后提供DRAWING_FINAL:开始绘画按钮
+- **不要立即开始绘画！**
+
+**阶段2 - 开始绘画（真正开始）：**
+当用户发送以下类型的消息时，才真正开始绘画：
+1. "开始绘画"、"开始画"、"开始作画"
+2. 单独的开始指令（不包含"请生成描述"等）
+
+**⚠️ 关键区别：**
+- "确认选择+请生成描述" → 生成总结+提供按钮
+- "开始绘画" → 直接开始，不再对话
+
+## 📝 **Meta Prompt生成**
+
+当决定开始绘画时，基于**整个对话历史**分析：
+
+## 📝 **完整绘画提示词**
+
+**用户核心需求：**
+用户想画一张 [从对话中提取的核心内容] 的图片
+
+**重要理解：用户选择多个选项的意图**
+当用户选择了多个元素、风格或概念时，这表示用户想要"尝试不同的感觉"，而不是要在一张图里全部包含。后续的多样性生成将为每个选择创建不同的图片重点。
+
+**确定要求（必须保持一致）：**
+- 主体内容：[用户明确要画的内容]
+- [只有当用户明确选择时才列出]艺术风格：[具体风格名称]
+- [只有当用户明确选择时才列出]情绪氛围：[具体氛围要求]  
+- [只有当用户明确选择时才列出]构图方式：[具体构图要求]
+- [其他用户在对话中明确表达的要求]
+
+**用户想要尝试的不同感觉：**
+- [如果用户选择了多个选项，在这里列出，说明将为每个创建不同的图片重点]
+
+**可变要求（用于多样性创作）：**
+- [用户在对话中没有涉及的方面，如：光影效果、背景细节、色彩细节等]
+
+**英文基础描述：**
+[结合确定要求生成的英文prompt基础，为多样性生成提供基础]
+
+DRAWING_FINAL:开始绘画
+
+## ⚠️ **DRAWING_FINAL格式要求**
+- DRAWING_FINAL:后面只能跟简短的按钮文字（如"开始绘画"）
+- 不要在DRAWING_FINAL:后面放置长文本或其他内容
+- 确保按钮文字不超过10个字符
+
+## 🎯 **对话原则**
+
+1. **🚨 一次一问**：每个回复只能问一个问题，只能有一个DRAWING_OPTIONS块
+2. **自然流畅**：像朋友聊天一样自然，但必须在需要选择时输出正确的DRAWING_OPTIONS格式
+3. **智能判断**：根据用户的回复判断下一步该问什么
+4. **随时可画**：用户随时可以开始绘画，不强求选完所有维度
+5. **记忆完整**：分析时要考虑整个对话的所有信息
+6. **避免重复**：不要重复询问用户已经明确的内容
+7. **耐心引导**：不要急于收集所有信息，一步一步来
+6. **格式规范**：绝对不要在回复中使用代码块符号（```），避免触发前端代码区显示
+
+**正确的对话流程示例：**
+
+**第1轮对话：**
+- 用户："我想画赛博朋克未来城市"
+- AI："Cyberpunk style is so cool! Which color tone feeling do you prefer?
+  DRAWING_OPTIONS:Neon Purple-Blue - Primarily purple and blue tones|Colorful Neon - Multiple colors intertwined|Cool Tech Blue - Cool-toned technological feel|Dark Red Metal - Deep red with metallic texture"
+
+**第2轮对话：**
+- 用户选择："霓虹紫蓝"
+- AI："Purple-blue tones really capture the cyberpunk feeling! What time background do you prefer?
+  DRAWING_OPTIONS:Midnight Neon - Bustling nightscape at midnight|Dusk Glow - City silhouette at sunset|Rainy Night Reflections - Neon reflections in rainwater|Dawn Mist - City looming in morning fog"
+
+**第3轮对话：**
+- 用户选择："深夜霓虹"，或者直接说"开始画吧" → 立即生成meta prompt并开始
+
+**⚠️ 关键：每轮只问一个问题，等用户回复后再继续！绝对不能一次问多个问题！**
+
+**完整示例 - 用户说"我想画一只可爱的小猫"时的正确回复：**
+```
+Kittens are so adorable! What kind of feeling do you want to create?
+
+DRAWING_OPTIONS:Fluffy Realistic - High-definition photographic level real kitten, detailed fur texture, warm natural lighting|Adorable Cartoon - Cute anime style kitten, big eyes and round face, vibrant colors|Elegant Oil Painting - Classical painting style elegant kitten, thick brushstrokes, artistic atmosphere|Fresh Watercolor - Transparent watercolor effect kitten, soft colors, beautiful mood
+```
+
+## 🎯 **示例响应模式**
+
+**阶段1示例 - 当用户说"我确认选择：动漫插画。请根据我之前的所有选择，生成一个完整详细的绘画提示词描述，并提供开始绘画的选项。"：**
+
+Alright! Based on our conversation, I've organized your complete drawing requirements:
+
+**User Core Requirements:**
+User wants to draw a cute cat using anime illustration style
+
+**Definite Requirements (must remain consistent):**
+- Subject Content: A cute cat
+- Art Style: Anime illustration style, big eyes, round face, vibrant colors
+
+**Variable Requirements (for diverse creation):**
+- Variations in expressions and actions
+- Different background environments  
+- Diverse color combinations
+
+**English Base Description:**
+A cute cat in anime illustration style, with big eyes and round face, colorful and vibrant
+
+DRAWING_FINAL:Start Drawing
 
-def download_image(image_url, save_path):
-    """Download image to local storage"""
-    try:
-        response = requests.get(image_url, stream=True)
-        response.raise_for_status()
-        
-        # Ensure directory exists
-        os.makedirs(os.path.dirname(save_path), exist_ok=True)
-        
-        with open(save_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                f.write(chunk)
-        
-        logger.info(f"Image download successful: {save_path}")
-        return True
-    except Exception as e:
-        logger.error(f"Image download failed: {e}")
-        return False
+**阶段2示例 - 当用户单独说"开始绘画"时，直接开始，不再生成任何文本！**
 
-def generate_diverse_prompts(base_prompt):
-    """
-    Generate four different diversified prompts based on base prompt
-    
-    Args:
-        base_prompt: Complete AI reply content including user requirement analysis and description
-        
-    Returns:
-        List containing four different prompts
-    """
-    try:
-        client = get_qwen_client()
-        
-        # Intelligently determine the type of input content
-        meta_keywords_chinese = [
-            '用户核心需求', '确定要求', '可变要求', '可接受选项', '英文基础描述',
-            '完整绘画提示词', '基于', '想画', '风格', '构图', '氛围'
-        ]
-        meta_keywords_english = [
-            'User core request', 'Key elements', 'must remain consistent', 'Optional variations',
-            'English base description', 'complete drawing prompt', 'based on', 'want to draw',
-            'style', 'composition', 'atmosphere', 'Subject:', 'Style:', 'Lighting:'
-        ]
-        is_meta_prompt = any(keyword in base_prompt for keyword in meta_keywords_chinese + meta_keywords_english)
-        
-        if is_meta_prompt:
-            logger.info("Detected structured AI reply, using intelligent analysis mode")
-            # If it's a structured AI reply, let AI intelligently analyze and generate diversity
-            system_content = '''You are a professional AI image prompt generator. You will receive a complete reply from an AI assistant that includes analysis of the user's image creation needs.
+**⚠️ 关键区别：确认选择阶段要生成总结+按钮，开始绘画阶段要直接开始！**
+
+## 🚨 **最终提醒**
+- **绝对禁止在一个回复中问多个问题**
+- **每个回复最多只能有一个DRAWING_OPTIONS块**
+- **一次一问，等用户回复后再继续**
+- **不要急于收集所有信息，要有耐心！**'''
+
+DIVERSIFY_META_PROMPT = '''You are a professional AI image prompt generator. You will receive a complete reply from an AI assistant that includes analysis of the user's image creation needs.
 
 ## 🎯 **Core Understanding**
 
@@ -269,10 +1458,8 @@ PROMPT4: [All definite requirements] + [Diversity variant 4] + [Technical qualit
 - Create 4 variants within the same logical dimension
 - Ensure each prompt is complete and directly usable for AI image generation in English
 - Use proper English grammar and punctuation'''
-        else:
-            logger.info("Detected simple English prompt, using generic diversity mode")
-            # If it's a simple English prompt, use generic diversity generation
-            system_content = '''You are a professional AI image prompt generator. You will receive a description and need to generate 4 English image prompts that **maintain core content consistency while diversifying details**.
+
+DIVERSIFY_SIMPLE_PROMPT = '''You are a professional AI image prompt generator. You will receive a description and need to generate 4 English image prompts that **maintain core content consistency while diversifying details**.
 
 ## 🎯 **Core Principles**
 
@@ -314,87 +1501,160 @@ PROMPT3: [Core content] + [Variant 3 details]
 PROMPT4: [Core content] + [Variant 4 details]
 
 **IMPORTANT: Use plain text format. Do NOT use markdown bold (**) or italic (*) formatting.**'''
-        
-        # Build AI conversation messages
-        messages = [
-            {
-                'role': 'system',
-                'content': system_content
-            },
-            {
+
+SUMMARY_SYSTEM_PROMPT = '''You maintain a running summary of a conversation between a user and an AI drawing assistant.
+Update the previous summary with the new messages. Keep every concrete choice the user made (subject, style, composition, colors, mood, details, rejected options) and the current state of the drawing plan. Drop pleasantries and repeated option lists. Reply with the updated summary only, in the language of the conversation, at most 200 words.'''
+
+prompt_templates = PromptRegistry()
+prompt_templates.register('chat_system', CHAT_SYSTEM_PROMPT)
+prompt_templates.register('diversify_meta', DIVERSIFY_META_PROMPT)
+prompt_templates.register('diversify_simple', DIVERSIFY_SIMPLE_PROMPT)
+prompt_templates.register('chat_summary', SUMMARY_SYSTEM_PROMPT)
+
+def detect_meta_prompt(base_prompt):
+    """True if base_prompt is a structured AI reply rather than a plain English prompt"""
+    meta_keywords_chinese = [
+        '用户核心需求', '确定要求', '可变要求', '可接受选项', '英文基础描述',
+        '完整绘画提示词', '基于', '想画', '风格', '构图', '氛围'
+    ]
+    meta_keywords_english = [
+        'User core request', 'Key elements', 'must remain consistent', 'Optional variations',
+        'English base description', 'complete drawing prompt', 'based on', 'want to draw',
+        'style', 'composition', 'atmosphere', 'Subject:', 'Style:', 'Lighting:'
+    ]
+    return any(keyword in base_prompt for keyword in meta_keywords_chinese + meta_keywords_english)
+
+class PromptStreamParser:
+    """
+    Incremental parser for PROMPTn: blocks in a streamed LLM reply
+    
+    feed() returns the prompts completed by the new text: a prompt is
+    complete once the next --- separator or PROMPTn: header arrives.
+    finish() returns the last prompt when the stream ends. Prompts are
+    stripped of markdown emphasis and newlines, and ones of 30 characters or
+    fewer are dropped.
+    """
+
+    HEADER = re.compile(r'(?:\*\*)?PROMPT\s*\d+\s*:(?:\*\*)?', re.IGNORECASE)
+    BOUNDARY = re.compile(r'---|(?:\*\*)?PROMPT\s*\d+\s*:', re.IGNORECASE)
+
+    def __init__(self):
+        self.buffer = ''
+
+    def feed(self, text):
+        self.buffer += text
+        prompts = []
+        while True:
+            header = self.HEADER.search(self.buffer)
+            if header is None:
+                break
+            boundary = self.BOUNDARY.search(self.buffer, header.end())
+            if boundary is None:
+                # 丢弃标题前的说明文字，保留未完成的prompt
+                self.buffer = self.buffer[header.start():]
+                break
+            prompt = self._clean(self.buffer[header.end():boundary.start()])
+            if prompt:
+                prompts.append(prompt)
+            self.buffer = self.buffer[boundary.start():]
+            if self.buffer.startswith('---'):
+                self.buffer = self.buffer[3:]
+        return prompts
+
+    def finish(self):
+        header = self.HEADER.search(self.buffer)
+        prompt = self._clean(self.buffer[header.end():]) if header else None
+        self.buffer = ''
+        return [prompt] if prompt else []
+
+    @staticmethod
+    def _clean(text):
+        prompt = re.sub(r'\n+', ' ', text.strip().rstrip('*').strip()).strip()
+        return prompt if len(prompt) > 30 else None
+
+def stream_diverse_prompts(base_prompt, fresh=False):
+    """
+    Yield four diversified prompts one at a time, as soon as each is parsed
+    
+    The completion is streamed so the first image can be submitted while
+    the LLM is still writing the others. Complete sets are cached; missing
+    prompts are filled in from the fallback generator, so exactly four are
+    always yielded.
+    """
+    is_meta_prompt = detect_meta_prompt(base_prompt)
+    cache_key = prompt_cache_key(base_prompt, is_meta_prompt)
+    if not fresh:
+        cached = prompt_cache.get(cache_key)
+        if cached is not None:
+            logger.info("Using cached diversified prompts")
+            yield from cached
+            return
+    
+    template_name = 'diversify_meta' if is_meta_prompt else 'diversify_simple'
+    prompts = []
+    stream = None
+    try:
+        started = time.time()
+        stream = get_qwen_client().chat.completions.create(
+            model="qwen-plus",
+            messages=prompt_templates.messages(template_name, {
                 'role': 'user',
                 'content': f'Please intelligently analyze the following content and generate four diversified image prompts:\n\n{base_prompt}'
-            }
-        ]
-        
-        # Call AI to generate response
-        response = client.chat.completions.create(
-            model="qwen-plus",
-            messages=messages,
-            stream=False,
-            temperature=0.7  # Moderate creativity
+            }),
+            stream=True,
+            stream_options={'include_usage': True},
+            temperature=0.7
         )
-        
-        ai_response = response.choices[0].message.content
-        prompt_type = "Structured AI reply analysis" if is_meta_prompt else "Simple prompt diversification"
-        logger.info(f"AI generated {prompt_type} response: {ai_response}")
-        
-        # Parse AI response and extract four prompts
-        prompts = []
-        
-        # Try multiple parsing strategies
-        # Strategy 1: Split by --- and look for PROMPT patterns
-        parts = ai_response.split('---')
-        logger.info(f"Got {len(parts)} parts after splitting by ---")
-        
-        for i, part in enumerate(parts):
-            part = part.strip()
-            # Handle various formats: PROMPT1:, **PROMPT1:**, PROMPT 1:, etc.
-            import re
-            prompt_match = re.search(r'(?:\*\*)?PROMPT\s*\d+\s*:(?:\*\*)?\s*(.*)', part, re.DOTALL | re.IGNORECASE)
-            if prompt_match:
-                prompt = prompt_match.group(1).strip()
-                # Remove any trailing markdown asterisks and clean up
-                prompt = prompt.rstrip('*').strip()
-                # Remove extra newlines and clean up text
-                prompt = re.sub(r'\n+', ' ', prompt).strip()
-                if prompt and len(prompt) > 30:  # Ensure prompt is not empty and has sufficient length
+        parser = PromptStreamParser()
+        usage = None
+        # 调用方在两次yield之间提交图片（限流等待+Liblib请求），这段时间不计入模板延迟
+        caller_seconds = 0
+        last_chunk = started
+        for chunk in stream:
+            last_chunk = time.time()
+            if chunk.usage is not None:
+                usage = chunk.usage
+            if not chunk.choices or not chunk.choices[0].delta.content:
+                continue
+            for prompt in parser.feed(chunk.choices[0].delta.content):
+                if len(prompts) < 4:
+                    logger.info(f"Streamed prompt {len(prompts) + 1} after {last_chunk - started - caller_seconds:.2f}s: {prompt[:100]}...")
                     prompts.append(prompt)
-                    logger.info(f"Successfully parsed prompt {i+1}: {prompt[:100]}...")
-                else:
-                    logger.warning(f"Prompt {i+1} is too short or empty: {prompt}")
-            else:
-                logger.info(f"Part {i+1} doesn't match PROMPT pattern: {part[:50]}...")
-        
-        # Strategy 2: If first strategy failed, try line-by-line parsing
-        if len(prompts) < 4:
-            logger.info("First parsing strategy insufficient, trying line-by-line parsing")
-            lines = ai_response.split('\n')
-            for line in lines:
-                line = line.strip()
-                prompt_match = re.search(r'(?:\*\*)?PROMPT\s*\d+\s*:(?:\*\*)?\s*(.*)', line, re.IGNORECASE)
-                if prompt_match:
-                    prompt = prompt_match.group(1).strip().rstrip('*').strip()
-                    if prompt and len(prompt) > 30:
-                        prompts.append(prompt)
-                        logger.info(f"Line-parsed prompt: {prompt[:100]}...")
-                        if len(prompts) >= 4:
-                            break
-        
-        # If parsing fails, fall back to constrained variant generation
-        if len(prompts) < 4:
-            logger.warning(f"Insufficient AI-generated prompts, only parsed {len(prompts)}, using intelligent fallback")
-            prompts = generate_intelligent_fallback_prompts(base_prompt, is_meta_prompt)
-        
-        logger.info(f"Final 4 diversified prompts generated:")
-        for i, prompt in enumerate(prompts[:4]):
-            logger.info(f"  {i+1}. {prompt}")
-        return prompts[:4]  # Ensure returning 4
-        
+                    handed_off = time.time()
+                    yield prompt
+                    caller_seconds += time.time() - handed_off
+        prompt_templates.record(template_name, last_chunk - started - caller_seconds, usage)
+        for prompt in parser.finish():
+            if len(prompts) < 4:
+                prompts.append(prompt)
+                yield prompt
     except Exception as e:
-        logger.error(f"Failed to generate diversified prompts: {e}")
-        # Fallback: generate intelligent fallback variants
-        return generate_intelligent_fallback_prompts(base_prompt, False)
+        logger.error(f"Failed to stream diversified prompts: {e}")
+    finally:
+        if stream is not None:
+            stream.close()
+    
+    if len(prompts) >= 4:
+        prompt_cache.set(cache_key, tuple(prompts[:4]))
+        return
+    logger.warning(f"Only streamed {len(prompts)} prompts, filling the rest with fallback prompts")
+    yield from generate_intelligent_fallback_prompts(base_prompt, is_meta_prompt)[len(prompts):4]
+
+def generate_diverse_prompts(base_prompt, fresh=False):
+    """
+    Generate four different diversified prompts based on base prompt
+    
+    Collects stream_diverse_prompts for callers that need the whole set at
+    once; cache, templates, parsing and fallback are shared with it.
+    
+    Args:
+        base_prompt: Complete AI reply content including user requirement analysis and description
+        fresh: Skip the prompt cache and ask the LLM for new variations
+        
+    Returns:
+        List containing four different prompts
+    """
+    return list(stream_diverse_prompts(base_prompt, fresh=fresh))
 
 def generate_intelligent_fallback_prompts(base_prompt, is_meta_prompt):
     """
@@ -456,366 +1716,1829 @@ def generate_intelligent_fallback_prompts(base_prompt, is_meta_prompt):
 
 
 
-def generate_single_image(task_id, image_index, prompt, callback_url=None):
-    """Worker thread for generating a single image"""
-    try:
-        # Update task status
-        if task_id in image_generation_tasks:
-            image_generation_tasks[task_id]['images'][image_index]['status'] = 'generating'
-        
-        # Submit generation task
-        uuid_ = submit_liblib_image_task(prompt)
-        if not uuid_:
-            if task_id in image_generation_tasks:
-                image_generation_tasks[task_id]['images'][image_index]['status'] = 'failed'
-                image_generation_tasks[task_id]['images'][image_index]['error'] = 'Task submission failed'
-            return
-        
-        # Wait for result
-        image_url = get_liblib_image_result(uuid_)
-        if not image_url:
-            if task_id in image_generation_tasks:
-                image_generation_tasks[task_id]['images'][image_index]['status'] = 'failed'
-                image_generation_tasks[task_id]['images'][image_index]['error'] = 'Generation failed'
-            return
-        
-        # Download image to local storage
-        filename = f"image_{task_id}_{image_index}_{int(time.time())}.jpg"
-        save_path = os.path.join('static', 'generated_images', filename)
-        
-        if download_image(image_url, save_path):
-            # Update task status
-            if task_id in image_generation_tasks:
-                image_generation_tasks[task_id]['images'][image_index]['status'] = 'completed'
-                image_generation_tasks[task_id]['images'][image_index]['url'] = f"/static/generated_images/{filename}"
-                image_generation_tasks[task_id]['images'][image_index]['original_url'] = image_url
-        else:
-            if task_id in image_generation_tasks:
-                image_generation_tasks[task_id]['images'][image_index]['status'] = 'failed'
-                image_generation_tasks[task_id]['images'][image_index]['error'] = 'Download failed'
-        
-    except Exception as e:
-        logger.error(f"Error generating image: {e}")
-        if task_id in image_generation_tasks:
-            image_generation_tasks[task_id]['images'][image_index]['status'] = 'failed'
-            image_generation_tasks[task_id]['images'][image_index]['error'] = str(e)
-
-def get_qwen_client():
-    """Get Qwen AI client"""
-    return OpenAI(
-        # Strongly recommend using environment variables or secure methods to manage your API Key
-        api_key=os.getenv("QWEN_API_KEY"),
-        base_url="https://dashscope.aliyuncs.com/compatible-mode/v1",
-    )
+def approx_size(value):
+    """Rough in-memory footprint of JSON-like state in bytes"""
+    if isinstance(value, str):
+        return 49 + len(value)
+    if isinstance(value, dict):
+        return 64 + sum(approx_size(k) + approx_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return 56 + 8 * len(value) + sum(approx_size(v) for v in value)
+    return 32
 
-def ask_qwen_stream(messages, model="qwen-plus"):
+class StateBudget:
     """
-    Send messages to Qwen and return streaming response generator
+    LRU bookkeeping for an in-process collection
     
-    Args:
-        messages: Message list
-        model: Model to use, defaults to qwen-plus
-        
-    Yields:
-        Streaming response data
+    Tracks the last access time and approximate size of every key. victims()
+    walks keys from least to most recently used and returns those that are
+    idle past the TTL or that keep the collection over its entry or byte
+    budget. A limit of 0 disables it.
     """
-    client = get_qwen_client()
-    
-    try:
-        # Call Qwen API with streaming response enabled
-        stream = client.chat.completions.create(
-            model=model,
-            messages=messages,
-            stream=True
-        )
-        
-        # Process streaming response
-        for chunk in stream:
-            content = chunk.choices[0].delta.content
-            if content:
-                yield content
-                
-    except Exception as e:
-        logger.error(f"Qwen API call failed: {e}")
-        yield f"Sorry, AI service is temporarily unavailable. Error message: {str(e)}"
-
-@app.route('/')
-def index():
-    """Homepage route"""
-    return render_template('index.html')
 
-@app.route('/api/chat', methods=['POST'])
-def chat():
-    """Handle chat requests"""
-    try:
-        data = request.json
-        message = data.get('message', '').strip()
-        chat_id = data.get('chat_id', 'default')
-        
-        if not message:
-            return jsonify({'error': 'Message cannot be empty'}), 400
-        
-        # Get or create chat session
-        if chat_id not in chat_sessions:
-            chat_sessions[chat_id] = {
-                'messages': [],
-                'created': time.time()
+    def __init__(self, ttl=0, max_entries=0, max_bytes=0):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> [size, last_access]
+        self.bytes = 0
+        self.evictions = {'ttl': 0, 'entries': 0, 'bytes': 0}
+
+    def touch(self, key, size=None, grow=0):
+        """Mark key as used; optionally set its size or grow it by a delta"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = [0, 0.0]
+            else:
+                self._entries.move_to_end(key)
+            new_size = (entry[0] if size is None else size) + grow
+            self.bytes += new_size - entry[0]
+            entry[0] = new_size
+            entry[1] = time.time()
+
+    def discard(self, key, reason=None):
+        """Forget key; reason ('ttl', 'entries', 'bytes') counts it as an eviction"""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return
+            self.bytes -= entry[0]
+            if reason:
+                self.evictions[reason] += 1
+
+    def victims(self):
+        """(key, reason) pairs to evict, least recently used first"""
+        now = time.time()
+        result = []
+        with self._lock:
+            entries = len(self._entries)
+            total = self.bytes
+            for key, (size, last_access) in self._entries.items():
+                if self.ttl and last_access + self.ttl < now:
+                    reason = 'ttl'
+                elif self.max_entries and entries > self.max_entries:
+                    reason = 'entries'
+                elif self.max_bytes and total > self.max_bytes:
+                    reason = 'bytes'
+                else:
+                    break
+                result.append((key, reason))
+                entries -= 1
+                total -= size
+        return result
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'approx_bytes': self.bytes,
+                'ttl': self.ttl,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'evictions': dict(self.evictions)
             }
+
+class StateJanitor:
+    """Background thread that periodically calls expire() on registered collections"""
+
+    def __init__(self, interval=60):
+        self.interval = interval
+        self.collections = {}
+        self._thread = None
+        self.sweeps = 0
+        self.removed = 0
+        self.last_sweep_ms = 0.0
+
+    def register(self, name, collection):
+        self.collections[name] = collection
+
+    def start(self):
+        if self._thread is None and self.interval > 0:
+            self._thread = Thread(target=self._run, name='state-janitor', daemon=True)
+            self._thread.start()
+
+    def sweep(self):
+        """Run one eviction pass; returns the number of entries removed"""
+        started = time.time()
+        removed = 0
+        for name, collection in self.collections.items():
+            try:
+                count = collection.expire()
+            except Exception as e:
+                logger.error(f"State janitor failed on {name}: {e}")
+                continue
+            if count:
+                logger.info(f"State janitor evicted {count} entries from {name}")
+            removed += count
+        self.sweeps += 1
+        self.removed += removed
+        self.last_sweep_ms = round((time.time() - started) * 1000, 2)
+        return removed
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.sweep()
+
+    def stats(self):
+        collections = {}
+        for name, collection in self.collections.items():
+            budget = getattr(collection, 'budget', None)
+            collections[name] = budget.stats() if budget else {'entries': collection.count()}
+        return {
+            'interval': self.interval,
+            'sweeps': self.sweeps,
+            'removed': self.removed,
+            'last_sweep_ms': self.last_sweep_ms,
+            'collections': collections
+        }
+
+class TaskRegistry:
+    """Storage interface for image generation tasks"""
+
+    # 其他进程也会写入时为True，等待方需要定期重新读取
+    shared = False
+
+    def create(self, task_id, task):
+        raise NotImplementedError
+
+    def get(self, task_id):
+        """Task dict, or None if missing or expired; counts as a client access for LRU eviction"""
+        raise NotImplementedError
+
+    def peek(self, task_id):
+        """Like get(), without refreshing the task's LRU position; for internal scans and checks"""
+        return self.get(task_id)
+
+    def update_image(self, task_id, image_index, fields):
+        """
+        Atomically merge fields into one image and bump the task version
         
-        session = chat_sessions[chat_id]
-        
-        # Add user message to session history
-        session['messages'].append({
-            'role': 'user',
-            'content': message
-        })
-        
-        # Prepare messages to send to AI (including conversation history)
-        messages = [
-            {
-                'role': 'system',
-                'content': '''⚠️ **Important Reminder: Only ask ONE question per reply! Absolutely no multiple questions at once!**
+        Returns:
+            (changed, status_changed), or None if the task does not exist.
+            Updates to a cancelled task are ignored.
+        """
+        raise NotImplementedError
 
-You are a professional AI drawing assistant. Your tasks are:
-1. Understand what users want to create through natural, progressive conversation (ask only one question at a time)
-2. Intelligently generate relevant follow-up questions based on user's specific choices (ask only one question at a time)
-3. Be ready to start drawing based on available information at any time
-4. Analyze definite requirements and variable requirements, generate intelligent meta prompts
+    def cancel(self, task_id):
+        """Mark a task cancelled and its unfinished images as cancelled; False if it does not exist"""
+        raise NotImplementedError
 
-## 🎨 **Conversation Strategy**
+    def task_ids(self, chat_id=None):
+        """Ids of all tasks, or only those started from chat_id"""
+        raise NotImplementedError
 
-### **🚨 Core Principle: Only ask one question at a time**
+    def delete(self, task_id):
+        raise NotImplementedError
 
-**⚠️ Absolutely forbidden to ask multiple questions in one reply!**
+    def expire(self):
+        """Drop tasks older than their TTL; returns the number removed"""
+        raise NotImplementedError
 
-- **One dimension at a time**: Each reply can only ask about one dimension choice, cannot ask about style + composition + color simultaneously
-- **One DRAWING_OPTIONS at a time**: Each reply can contain at most one DRAWING_OPTIONS block
-- **Progressive conversation**: Wait for user to choose this question, then ask the next question in the next round
-- **Natural guidance**: First show interest in user's ideas, then naturally guide to a specific question
-- **Avoid greediness**: Don't try to collect all information at once, be patient and go step by step
+    def count(self):
+        raise NotImplementedError
 
-**❌ Wrong Example:**
-```
-What style do you want?
-DRAWING_OPTIONS:Realistic|Anime|Oil Painting|Watercolor
+def cancel_task_images(task):
+    """Apply a cancellation to a task dict; returns True if anything changed"""
+    if task.get('cancelled'):
+        return False
+    task['cancelled'] = True
+    for image in task['images']:
+        if image['status'] in ('pending', 'generating'):
+            image['status'] = 'cancelled'
+    task['version'] = task.get('version', 0) + 1
+    return True
+
+def merge_image_fields(image, fields):
+    """Apply fields to an image dict; returns (changed, status_changed)"""
+    changed = any(image.get(key) != value for key, value in fields.items())
+    status_changed = 'status' in fields and fields['status'] != image.get('status')
+    image.update(fields)
+    return changed, status_changed
+
+class MemoryTaskRegistry(TaskRegistry):
+    """In-process dict backend with an LRU entry/byte budget"""
+
+    def __init__(self, ttl, max_entries=0, max_bytes=0):
+        self.ttl = ttl
+        self.tasks = {}
+        self._lock = threading.Lock()
+        self.budget = StateBudget(ttl, max_entries, max_bytes)
+
+    def create(self, task_id, task):
+        with self._lock:
+            self.tasks[task_id] = task
+        self.budget.touch(task_id, size=approx_size(task))
+
+    def get(self, task_id):
+        task = self.peek(task_id)
+        if task is not None:
+            self.budget.touch(task_id)
+        return task
+
+    def peek(self, task_id):
+        task = self.tasks.get(task_id)
+        if task is None or task['created'] + self.ttl < time.time():
+            return None
+        return task
+
+    def update_image(self, task_id, image_index, fields):
+        with self._lock:
+            task = self.tasks.get(task_id)
+            if task is None:
+                return None
+            if task.get('cancelled'):
+                return False, False
+            image = task['images'][image_index]
+            before = approx_size(image)
+            changed, status_changed = merge_image_fields(image, fields)
+            if changed:
+                task['version'] = task.get('version', 0) + 1
+        self.budget.touch(task_id, grow=approx_size(image) - before)
+        return changed, status_changed
+
+    def cancel(self, task_id):
+        with self._lock:
+            task = self.tasks.get(task_id)
+            if task is None:
+                return False
+            cancel_task_images(task)
+            return True
+
+    def task_ids(self, chat_id=None):
+        if chat_id is None:
+            return list(self.tasks.keys())
+        return [task_id for task_id, task in list(self.tasks.items()) if task['chat_id'] == chat_id]
+
+    def delete(self, task_id):
+        with self._lock:
+            removed = self.tasks.pop(task_id, None) is not None
+        self.budget.discard(task_id)
+        return removed
+
+    def expire(self):
+        cutoff = time.time() - self.ttl
+        with self._lock:
+            victims = [(task_id, 'ttl') for task_id, task in self.tasks.items() if task['created'] < cutoff]
+        victims += self.budget.victims()
+        removed = 0
+        for task_id, reason in victims:
+            with self._lock:
+                if self.tasks.pop(task_id, None) is not None:
+                    removed += 1
+            self.budget.discard(task_id, reason)
+        return removed
+
+    def count(self):
+        return len(self.tasks)
+
+def gevent_patched():
+    """True when running under gevent monkey patching (gunicorn -k gevent)"""
+    if 'gevent' not in sys.modules:
+        return False
+    from gevent import monkey
+    return monkey.is_module_patched('threading')
 
-What composition do you prefer?
-DRAWING_OPTIONS:Close-up|Full Body|Environmental|Dynamic
-```
+def os_thread_local():
+    """
+    Storage local to the OS thread
+    
+    Under gevent threading.local is per greenlet, which would give every open
+    request its own SQLite connection. SQLite calls never yield to other
+    greenlets, so greenlets on the same OS thread can share one connection.
+    """
+    if gevent_patched():
+        from gevent import monkey
+        return monkey.get_original('threading', 'local')()
+    return threading.local()
 
-**✅ Correct Example:**
-```
-What style do you want?
-DRAWING_OPTIONS:Realistic|Anime|Oil Painting|Watercolor
-```
-Wait for user to choose, then ask about composition in the next round.
+class SQLiteTaskRegistry(TaskRegistry):
+    """
+    SQLite (WAL) backend so any gunicorn worker can serve status reads
+    
+    Each task is one row holding its JSON state; image updates run in a
+    BEGIN IMMEDIATE transaction so concurrent writers never lose updates.
+    """
 
-### **Dynamic Question Strategy**
+    shared = True
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self._local = os_thread_local()
+        self._connect().executescript('''
+            CREATE TABLE IF NOT EXISTS image_tasks (
+                task_id TEXT PRIMARY KEY,
+                data TEXT NOT NULL,
+                expires REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_image_tasks_expires ON image_tasks (expires);
+        ''')
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA busy_timeout=30000')
+            self._local.conn = conn
+        return conn
+
+    def create(self, task_id, task):
+        self._connect().execute(
+            'INSERT OR REPLACE INTO image_tasks (task_id, data, expires) VALUES (?, ?, ?)',
+            (task_id, json.dumps(task), task['created'] + self.ttl)
+        )
 
-**Core Idea: Generate relevant questions based on user's specific expressions**
+    def get(self, task_id):
+        row = self._connect().execute(
+            'SELECT data FROM image_tasks WHERE task_id = ? AND expires > ?', (task_id, time.time())
+        ).fetchone()
+        return json.loads(row[0]) if row else None
 
-**Example 1 - If user says "I want to draw a cute kitten":**
-- Don't directly ask "What style do you prefer?"
-- Should respond naturally then provide options:
-```
-Kittens are so cute! What kind of feeling do you want to create?
+    def update_image(self, task_id, image_index, fields):
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT data FROM image_tasks WHERE task_id = ?', (task_id,)).fetchone()
+            if row is None:
+                conn.execute('COMMIT')
+                return None
+            task = json.loads(row[0])
+            if task.get('cancelled'):
+                conn.execute('COMMIT')
+                return False, False
+            changed, status_changed = merge_image_fields(task['images'][image_index], fields)
+            if changed:
+                task['version'] = task.get('version', 0) + 1
+                conn.execute('UPDATE image_tasks SET data = ? WHERE task_id = ?', (json.dumps(task), task_id))
+            conn.execute('COMMIT')
+            return changed, status_changed
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def cancel(self, task_id):
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT data FROM image_tasks WHERE task_id = ?', (task_id,)).fetchone()
+            if row is None:
+                conn.execute('COMMIT')
+                return False
+            task = json.loads(row[0])
+            if cancel_task_images(task):
+                conn.execute('UPDATE image_tasks SET data = ? WHERE task_id = ?', (json.dumps(task), task_id))
+            conn.execute('COMMIT')
+            return True
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def task_ids(self, chat_id=None):
+        if chat_id is None:
+            rows = self._connect().execute('SELECT task_id FROM image_tasks')
+        else:
+            rows = self._connect().execute(
+                "SELECT task_id FROM image_tasks WHERE json_extract(data, '$.chat_id') = ?", (chat_id,)
+            )
+        return [row[0] for row in rows]
+
+    def delete(self, task_id):
+        cursor = self._connect().execute('DELETE FROM image_tasks WHERE task_id = ?', (task_id,))
+        return cursor.rowcount > 0
+
+    def expire(self):
+        cursor = self._connect().execute('DELETE FROM image_tasks WHERE expires <= ?', (time.time(),))
+        return cursor.rowcount
+
+    def count(self):
+        return self._connect().execute('SELECT COUNT(*) FROM image_tasks').fetchone()[0]
+
+def create_task_registry():
+    """Build the task registry selected by IMAGE_TASK_STORE"""
+    if IMAGE_TASK_STORE == 'sqlite':
+        logger.info(f"Using SQLite image task registry: {IMAGE_TASK_DB_PATH}")
+        return SQLiteTaskRegistry(IMAGE_TASK_DB_PATH, IMAGE_TASK_TTL)
+    return MemoryTaskRegistry(IMAGE_TASK_TTL, IMAGE_TASK_MAX_ENTRIES, IMAGE_TASK_MAX_BYTES)
+
+task_registry = create_task_registry()
+
+def build_task_status(task_id, task):
+    """Build the status payload of an image generation task"""
+    # 计算整体状态
+    all_completed = all(img['status'] == 'completed' for img in task['images'])
+    any_failed = any(img['status'] == 'failed' for img in task['images'])
+    any_generating = any(img['status'] == 'generating' for img in task['images'])
+    
+    if task.get('cancelled'):
+        overall_status = 'cancelled'
+    elif all_completed:
+        overall_status = 'completed'
+    elif any_failed and not any_generating:
+        overall_status = 'failed'
+    elif any_generating:
+        overall_status = 'generating'
+    else:
+        overall_status = 'pending'
+    
+    return {
+        'task_id': task_id,
+        'status': overall_status,
+        'base_prompt': task.get('base_prompt', task.get('prompt', '')),  # 兼容旧格式
+        'chat_id': task['chat_id'],
+        'created': task['created'],
+        'version': task.get('version', 0),
+        'images': [dict(img) for img in task['images']]  # 现在包含每张图片的prompt信息
+    }
 
-DRAWING_OPTIONS:Fluffy Realistic - High-definition photographic level real kitten, detailed fur texture, warm natural lighting|Adorable Cartoon - Cute anime style kitten, big eyes and round face, vibrant colors|Elegant Oil Painting - Classical painting style elegant kitten, thick brushstrokes, artistic atmosphere|Fresh Watercolor - Transparent watercolor effect kitten, soft colors, beautiful mood
-```
+def is_task_finished(payload):
+    """True once every image of a status payload has completed, failed or been cancelled"""
+    return all(img['status'] in ('completed', 'failed', 'cancelled') for img in payload['images'])
+
+def subscribe_task_events(task_id):
+    """Register a queue that receives the task status payload on every image state change"""
+    events = queue.Queue()
+    with task_event_lock:
+        task_event_subscribers.setdefault(task_id, []).append(events)
+    return events
+
+def unsubscribe_task_events(task_id, events):
+    with task_event_lock:
+        subscribers = task_event_subscribers.get(task_id, [])
+        if events in subscribers:
+            subscribers.remove(events)
+        if not subscribers:
+            task_event_subscribers.pop(task_id, None)
+
+def publish_task_event(task_id):
+    """Send the current task status to every subscriber of the task"""
+    with task_event_lock:
+        subscribers = list(task_event_subscribers.get(task_id, []))
+    if not subscribers:
+        return
+    task = task_registry.peek(task_id)
+    if task is None:
+        return
+    payload = build_task_status(task_id, task)
+    for events in subscribers:
+        events.put(payload)
+
+def wait_for_task_version(task_id, known_version, timeout):
+    """Block until the task's version differs from known_version or timeout passes; returns the task"""
+    deadline = time.time() + timeout
+    with task_version_cond:
+        while True:
+            task = task_registry.peek(task_id)
+            if task is None or task.get('version', 0) != known_version:
+                return task
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return task
+            # 共享注册表的更新可能来自其他worker，需要定期重新读取
+            if task_registry.shared:
+                remaining = min(remaining, TASK_REGISTRY_POLL_INTERVAL)
+            task_version_cond.wait(remaining)
+
+def update_image_state(task_id, image_index, **fields):
+    """Update one image entry of a generation task, ignoring tasks that no longer exist"""
+    result = task_registry.update_image(task_id, image_index, fields)
+    if result is None:
+        return False
+    changed, status_changed = result
+    if changed:
+        # 唤醒长轮询等待方
+        with task_version_cond:
+            task_version_cond.notify_all()
+    if status_changed or (changed and 'variants' in fields):
+        # 缩略图晚于完成状态到达时也要推送，否则网格一直加载原图
+        publish_task_event(task_id)
+    return True
+
+def is_task_cancelled(task_id):
+    """True if the task was cancelled or no longer exists, so remaining work can be skipped"""
+    task = task_registry.peek(task_id)
+    return task is None or bool(task.get('cancelled'))
+
+def cancel_image_task(task_id):
+    """Cancel a generation task: pending submissions, polls and downloads for it are skipped"""
+    if not task_registry.cancel(task_id):
+        return False
+    logger.info(f"Cancelled image generation task {task_id}")
+    with task_version_cond:
+        task_version_cond.notify_all()
+    publish_task_event(task_id)
+    return True
 
-**Example 2 - If user chose "Anime Illustration" style:**
-- Continue deeper based on anime characteristics
-```
-Since you like anime illustration style, for the kitten's expression, which anime feeling do you prefer?
+class ImageResultCache:
+    """
+    Content-addressed cache of generated images keyed on the full Liblib request
+    
+    Only requests with a pinned seed are deterministic, so only those are
+    cached. Entries are evicted least-recently-used beyond max_entries, and
+    dropped when their file has disappeared from disk.
+    """
 
-DRAWING_OPTIONS:Fresh Daily Life - Warm daily feeling like Miyazaki films, fresh natural colors|Dreamy Girl - Sweet and cute shoujo manga style, dreamy bubbles and flower elements|Healing Cute Pet - Adorable style like Totoro and Pikachu that makes people happy|Simple Lines - Clean and simple lines and color blocks, modern anime's minimalist beauty
-```
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.stale = 0
+
+    @staticmethod
+    def key_for(request_body):
+        """Hash of the request body, or None when the result is not deterministic"""
+        if request_body['generateParams'].get('seed', -1) == -1:
+            return None
+        canonical = json.dumps(request_body, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(canonical.encode()).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and not os.path.exists(entry['path']):
+                del self._entries[key]
+                self.stale += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return dict(entry)
+
+    def put(self, key, path, url, original_url, variants=None):
+        with self._lock:
+            self._entries[key] = {'path': path, 'url': url, 'original_url': original_url, 'variants': variants}
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'stale': self.stale
+            }
 
-**Example 3 - If user chose "Realistic Photography":**
-- Focus on photography and kitten specific combination
-```
-Realistic photography of a kitten must be very charming! What kind of photography feeling do you prefer?
+image_result_cache = ImageResultCache(max_entries=int(os.getenv("IMAGE_CACHE_MAX_ENTRIES", "1024")))
 
-DRAWING_OPTIONS:Natural Lighting - Sunlight through windows shining on the kitten, warm home environment|Professional Studio - Perfect lighting setup, highlighting kitten's fur texture and eyes|Outdoor Portrait - Kitten's natural state in garden or grass|Artistic Portrait - Creative composition and lighting, showing kitten's elegant temperament
-```
+def finish_generated_image(task_id, image_index, image_url, cache_key=None):
+    """Download a finished Liblib image and mark it completed"""
+    # Download image to local storage
+    filename = f"image_{task_id}_{image_index}_{int(time.time())}.jpg"
+    save_path = image_store.path_for(filename)
+    
+    result = download_image(image_url, save_path)
+    download_pipeline.record(result)
+    if result:
+        url = static_url(save_path)
+        # 网格首次显示就加载缩略图：短暂等待编码完成再标记完成
+        future = derivative_pipeline.submit(save_path)
+        variant_paths = None
+        late = False
+        if future is not None:
+            try:
+                variant_paths = derivative_pipeline.result(future, DERIVATIVE_FIRST_PAINT_WAIT)
+            except FutureTimeoutError:
+                late = True
+        variants = {name: static_url(path) for name, path in variant_paths.items()} if variant_paths else None
+        update_image_state(
+            task_id, image_index,
+            status='completed',
+            url=url,
+            variants=variants,
+            original_url=image_url,
+            sha256=result['sha256'],
+            bytes=result['bytes'],
+            download_seconds=round(result['seconds'], 3)
+        )
+        # 图片已下载并标记完成，之后的缩略图/存储索引/配额出错都不能再把它标记为失败
+        try:
+            if late:
+                # 编码较慢：先以原图完成，缩略图就绪后再推送
+                try:
+                    variant_paths = derivative_pipeline.result(future, max(0, DERIVATIVE_TIMEOUT - DERIVATIVE_FIRST_PAINT_WAIT))
+                except FutureTimeoutError:
+                    logger.error(f"Image derivatives for {save_path} timed out")
+                if variant_paths:
+                    variants = {name: static_url(path) for name, path in variant_paths.items()}
+                    update_image_state(task_id, image_index, variants=variants)
+            image_store.add(save_path, *(variant_paths or {}).values())
+        except Exception as e:
+            logger.error(f"Failed to register {save_path} in the image store: {e}")
+        if cache_key:
+            image_result_cache.put(cache_key, save_path, url, image_url, variants)
+    else:
+        update_image_state(task_id, image_index, status='failed', error='Download failed')
 
-### **🚨 重要：DRAWING_OPTIONS格式要求**
-- 必须使用DRAWING_OPTIONS:开头
-- 选项之间用|分隔（这点非常重要！）
-- 每个选项包含名称和描述，用-分隔
-- 前面要有自然的引导性文字
-- **每个回复最多只能有一个DRAWING_OPTIONS块！**
-- **绝对不能在一个回复中问多个问题！**
+def generate_single_image(task_id, image_index, prompt, callback_url=None, options=None):
+    """Submit a single image; polling and download are handed to liblib_poller"""
+    try:
+        if is_task_cancelled(task_id):
+            return
+        
+        # 相同参数（固定seed）的结果已生成过时直接复用本地文件
+        request_body = build_liblib_request(prompt, options)
+        cache_key = ImageResultCache.key_for(request_body)
+        cached = image_result_cache.get(cache_key) if cache_key else None
+        if cached:
+            image_store.touch(cached['path'])
+            update_image_state(
+                task_id, image_index,
+                status='completed',
+                url=cached['url'],
+                variants=cached['variants'],
+                original_url=cached['original_url'],
+                cache_hit=True
+            )
+            return
+        
+        # Update task status
+        update_image_state(task_id, image_index, status='generating')
+        
+        # Submit generation task
+        uuid_ = submit_liblib_image_task(prompt, options)
+        if not uuid_:
+            update_image_state(task_id, image_index, status='failed', error='Task submission failed')
+            return
+        
+        # Wait for result without holding this thread
+        update_image_state(task_id, image_index, generate_uuid=uuid_)
+        liblib_poller.track(
+            uuid_, task_id, image_index,
+            profile_key=liblib_profile_key(request_body['generateParams']),
+            cache_key=cache_key
+        )
+        
+    except Exception as e:
+        logger.error(f"Error generating image: {e}")
+        update_image_state(task_id, image_index, status='failed', error=str(e))
 
-### **何时提供选择选项**
-除以下情况外，**每次回复都必须包含DRAWING_OPTIONS**：
-- 用户明确说"开始绘画"、"开始画"等
-- 用户已经提供了足够信息且主动建议开始绘画
-- 用户表达不耐烦想直接开始
+class PoolSaturated(Exception):
+    """Raised when the image generation pool cannot admit more work"""
 
-**典型需要提供选项的情况：**
-- 用户刚说想画什么（如"我想画小猫"）
-- 用户选择了一个选项，需要进一步细化
-- 对话还在探索和确定需求阶段
+    def __init__(self, retry_after):
+        super().__init__('Image generation queue is full')
+        self.retry_after = retry_after
 
-### **智能判断何时深入**
-- 根据用户当前的信息量判断是否需要继续询问
-- 如果用户表达已经比较完整，主动建议开始绘画
-- 避免无意义的重复询问
+class ImageGenerationPool:
+    """
+    Bounded worker pool for image generation jobs with admission control
+    
+    At most `workers` jobs run at once and at most `queue_depth` more wait
+    for a worker; anything beyond that is rejected with an estimated
+    Retry-After instead of spawning more threads.
+    """
 
-### **🚨 关键流程控制**
+    def __init__(self, workers=4, queue_depth=32):
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='image-gen')
+        self._lock = threading.Lock()
+        self._admitted = 0
+        self._running = 0
+        self.completed = 0
+        self.rejected = 0
+        self.avg_wait = 0.0
+        self.max_wait = 0.0
+        self.avg_service = 5.0
+
+    def retry_after(self):
+        """Estimated seconds until a slot frees up"""
+        with self._lock:
+            queued = max(0, self._admitted - self._running)
+            return max(1, int(math.ceil((queued / self.workers + 1) * self.avg_service)))
+
+    def admit(self):
+        """Reserve a slot for a job, raising PoolSaturated when the queue is full"""
+        with self._lock:
+            if self._admitted < self.workers + self.queue_depth:
+                self._admitted += 1
+                return
+            self.rejected += 1
+        raise PoolSaturated(self.retry_after())
+
+    def release(self):
+        """Give back a slot reserved by admit() that will not be submitted"""
+        with self._lock:
+            self._admitted -= 1
+
+    def submit(self, fn, *args):
+        """Run fn on the pool; the caller must have reserved a slot with admit()"""
+        enqueued = time.time()
+
+        def run():
+            started = time.time()
+            with self._lock:
+                self._running += 1
+                wait = started - enqueued
+                self.avg_wait += 0.2 * (wait - self.avg_wait)
+                self.max_wait = max(self.max_wait, wait)
+            try:
+                fn(*args)
+            except Exception as e:
+                logger.error(f"Image generation job failed: {e}")
+            finally:
+                with self._lock:
+                    self._running -= 1
+                    self._admitted -= 1
+                    self.completed += 1
+                    self.avg_service += 0.2 * (time.time() - started - self.avg_service)
 
-**流程分为两个阶段：**
+        try:
+            self._executor.submit(run)
+        except Exception:
+            self.release()
+            raise
+
+    def stats(self):
+        """Queue depth, wait times and rejection counters"""
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'queue_capacity': self.queue_depth,
+                'running': self._running,
+                'queued': max(0, self._admitted - self._running),
+                'completed': self.completed,
+                'rejected': self.rejected,
+                'avg_wait': round(self.avg_wait, 3),
+                'max_wait': round(self.max_wait, 3),
+                'avg_service': round(self.avg_service, 3)
+            }
 
-**阶段1 - 确认选择（生成总结）：**
-当用户发送"我确认选择：XXX。请根据我之前的所有选择，生成一个完整详细的绘画提示词描述，并提供开始绘画的选项。"时：
-- 生成完整的meta prompt总结
-- 在最后提供DRAWING_FINAL:开始绘画按钮
-- **不要立即开始绘画！**
+image_generation_pool = ImageGenerationPool(
+    workers=int(os.getenv("IMAGE_POOL_WORKERS", "4")),
+    queue_depth=int(os.getenv("IMAGE_QUEUE_DEPTH", "32"))
+)
+
+class QwenClientPool:
+    """Process-wide Qwen client sharing one keep-alive HTTP connection pool"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._client = None
+        self._stats_lock = threading.Lock()
+        self._seen_streams = weakref.WeakSet()
+        self.requests = 0
+        self.new_connections = 0
+        self.reused_connections = 0
+
+    def _on_response(self, response):
+        # 每个底层连接对应一个network_stream，出现过的即为复用的连接
+        stream = response.extensions.get('network_stream')
+        with self._stats_lock:
+            self.requests += 1
+            if stream is None:
+                return
+            if stream in self._seen_streams:
+                self.reused_connections += 1
+            else:
+                self._seen_streams.add(stream)
+                self.new_connections += 1
+
+    def get_client(self):
+        """Return the shared OpenAI client, creating it on first use"""
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    http_client = httpx.Client(
+                        limits=httpx.Limits(
+                            max_connections=QWEN_POOL_MAX_CONNECTIONS,
+                            max_keepalive_connections=QWEN_POOL_MAX_KEEPALIVE,
+                            keepalive_expiry=QWEN_KEEPALIVE_EXPIRY
+                        ),
+                        timeout=httpx.Timeout(
+                            QWEN_READ_TIMEOUT,
+                            connect=QWEN_CONNECT_TIMEOUT,
+                            pool=QWEN_POOL_TIMEOUT
+                        ),
+                        event_hooks={'response': [self._on_response]}
+                    )
+                    self._client = OpenAI(
+                        # Strongly recommend using environment variables or secure methods to manage your API Key
+                        api_key=os.getenv("QWEN_API_KEY"),
+                        base_url=QWEN_BASE_URL,
+                        http_client=http_client,
+                        max_retries=QWEN_MAX_RETRIES
+                    )
+        return self._client
+
+    def stats(self):
+        """Connection reuse statistics"""
+        with self._stats_lock:
+            return {
+                'initialized': self._client is not None,
+                'requests': self.requests,
+                'new_connections': self.new_connections,
+                'reused_connections': self.reused_connections,
+                'max_connections': QWEN_POOL_MAX_CONNECTIONS,
+                'max_keepalive_connections': QWEN_POOL_MAX_KEEPALIVE
+            }
 
-**阶段2 - 开始绘画（真正开始）：**
-当用户发送以下类型的消息时，才真正开始绘画：
-1. "开始绘画"、"开始画"、"开始作画"
-2. 单独的开始指令（不包含"请生成描述"等）
+qwen_client_pool = QwenClientPool()
 
-**⚠️ 关键区别：**
-- "确认选择+请生成描述" → 生成总结+提供按钮
-- "开始绘画" → 直接开始，不再对话
+def get_qwen_client():
+    """Get Qwen AI client (shared across threads, reuses keep-alive connections)"""
+    return qwen_client_pool.get_client()
 
-## 📝 **Meta Prompt生成**
+def chat_title(first_user_message):
+    """Sidebar title for a chat: its first user message, truncated"""
+    if not first_user_message:
+        return 'New Conversation'
+    return first_user_message[:30] + ('...' if len(first_user_message) > 30 else '')
 
-当决定开始绘画时，基于**整个对话历史**分析：
+class ChatStore:
+    """Storage interface for chat sessions"""
 
-## 📝 **完整绘画提示词**
+    def flush(self):
+        """Make queued writes visible to other workers; a no-op for stores that write through"""
 
-**用户核心需求：**
-用户想画一张 [从对话中提取的核心内容] 的图片
+    def exists(self, chat_id):
+        raise NotImplementedError
 
-**重要理解：用户选择多个选项的意图**
-当用户选择了多个元素、风格或概念时，这表示用户想要"尝试不同的感觉"，而不是要在一张图里全部包含。后续的多样性生成将为每个选择创建不同的图片重点。
+    def ensure(self, chat_id):
+        """Create the chat if it does not exist"""
+        raise NotImplementedError
 
-**确定要求（必须保持一致）：**
-- 主体内容：[用户明确要画的内容]
-- [只有当用户明确选择时才列出]艺术风格：[具体风格名称]
-- [只有当用户明确选择时才列出]情绪氛围：[具体氛围要求]  
-- [只有当用户明确选择时才列出]构图方式：[具体构图要求]
-- [其他用户在对话中明确表达的要求]
+    def append_message(self, chat_id, role, content):
+        raise NotImplementedError
 
-**用户想要尝试的不同感觉：**
-- [如果用户选择了多个选项，在这里列出，说明将为每个创建不同的图片重点]
+    def get_messages(self, chat_id, limit=None):
+        """Messages of a chat in order, optionally only the last `limit`"""
+        raise NotImplementedError
 
-**可变要求（用于多样性创作）：**
-- [用户在对话中没有涉及的方面，如：光影效果、背景细节、色彩细节等]
+    def get_info(self, chat_id):
+        """Summary (id, title, created, message_count) of one chat, or None"""
+        raise NotImplementedError
 
-**英文基础描述：**
-[结合确定要求生成的英文prompt基础，为多样性生成提供基础]
+    def get_message_range(self, chat_id, before=None, since=None, limit=None):
+        """
+        Messages with stable ids ({'id', 'role', 'content', 'tokens'}) in order
+        
+        With `since`, the first `limit` messages whose id is greater than it;
+        otherwise the last `limit` messages whose id is below `before`.
+        Token counts are estimated once when a message is appended.
+        """
+        raise NotImplementedError
+
+    def get_summary(self, chat_id):
+        """(summary, upto_id): running summary of the messages up to upto_id"""
+        raise NotImplementedError
+
+    def set_summary(self, chat_id, summary, upto_id):
+        raise NotImplementedError
+
+    def list_chats(self, limit=None, before=None):
+        """
+        Chat summaries (id, title, created, message_count), newest first
+        
+        Args:
+            limit: maximum number of chats to return
+            before: (created, chat_id) of the last chat on the previous page
+        """
+        raise NotImplementedError
+
+    def delete(self, chat_id):
+        """Delete a chat; returns False if it did not exist"""
+        raise NotImplementedError
+
+    def expire(self):
+        """Evict idle or over-budget chats; durable backends keep everything"""
+        return 0
+
+    def count(self):
+        raise NotImplementedError
+
+class MemoryChatStore(ChatStore):
+    """In-process dict backend (per worker, lost on restart) with idle TTL and LRU budget"""
+
+    def __init__(self, ttl=0, max_sessions=0, max_bytes=0):
+        self.sessions = {}
+        # (created, chat_id) 升序排列，用于分页列出会话
+        self._order = []
+        self._lock = threading.Lock()
+        self.budget = StateBudget(ttl, max_sessions, max_bytes)
+
+    def exists(self, chat_id):
+        return chat_id in self.sessions
+
+    def ensure(self, chat_id):
+        with self._lock:
+            if chat_id not in self.sessions:
+                self.sessions[chat_id] = {
+                    'messages': [],
+                    'tokens': [],
+                    'created': time.time(),
+                    'title': None,
+                    'summary': None,
+                    'summary_upto': 0
+                }
+                bisect.insort(self._order, (self.sessions[chat_id]['created'], chat_id))
+                self.budget.touch(chat_id, size=approx_size(self.sessions[chat_id]))
+
+    def append_message(self, chat_id, role, content):
+        self.ensure(chat_id)
+        session = self.sessions[chat_id]
+        message = {
+            'role': role,
+            'content': content
+        }
+        session['messages'].append(message)
+        session['tokens'].append(estimate_tokens(content))
+        # 第一条用户消息作为标题
+        if role == 'user' and session['title'] is None:
+            session['title'] = chat_title(content)
+        self.budget.touch(chat_id, grow=approx_size(message) + 48)
+
+    def get_messages(self, chat_id, limit=None):
+        session = self.sessions.get(chat_id)
+        if session is None:
+            return []
+        self.budget.touch(chat_id)
+        messages = session['messages']
+        return list(messages[-limit:] if limit else messages)
+
+    def get_info(self, chat_id):
+        session = self.sessions.get(chat_id)
+        if session is None:
+            return None
+        return {
+            'id': chat_id,
+            'title': session['title'] or chat_title(None),
+            'created': session['created'],
+            'message_count': len(session['messages'])
+        }
 
-DRAWING_FINAL:开始绘画
+    def get_message_range(self, chat_id, before=None, since=None, limit=None):
+        session = self.sessions.get(chat_id)
+        if session is None:
+            return []
+        self.budget.touch(chat_id)
+        # 内存会话只追加，消息id就是从1开始的序号
+        messages = session['messages']
+        tokens = session['tokens']
+        if since is not None:
+            start = max(since, 0)
+            end = min(start + limit, len(messages)) if limit else len(messages)
+        else:
+            end = min(before - 1, len(messages)) if before is not None else len(messages)
+            end = max(end, 0)
+            start = max(end - limit, 0) if limit else 0
+        return [
+            {'id': index + 1, 'role': messages[index]['role'], 'content': messages[index]['content'],
+             'tokens': tokens[index]}
+            for index in range(start, end)
+        ]
 
-## ⚠️ **DRAWING_FINAL格式要求**
-- DRAWING_FINAL:后面只能跟简短的按钮文字（如"开始绘画"）
-- 不要在DRAWING_FINAL:后面放置长文本或其他内容
-- 确保按钮文字不超过10个字符
+    def get_summary(self, chat_id):
+        session = self.sessions.get(chat_id)
+        if session is None:
+            return None, 0
+        return session['summary'], session['summary_upto']
 
-## 🎯 **对话原则**
+    def set_summary(self, chat_id, summary, upto_id):
+        session = self.sessions.get(chat_id)
+        if session is None or upto_id <= session['summary_upto']:
+            return
+        previous = session['summary']
+        session['summary'] = summary
+        session['summary_upto'] = upto_id
+        self.budget.touch(chat_id, grow=len(summary) - len(previous or ''))
+
+    def list_chats(self, limit=None, before=None):
+        with self._lock:
+            end = bisect.bisect_left(self._order, before) if before else len(self._order)
+            start = max(0, end - limit) if limit else 0
+            page = self._order[start:end]
+        chats = []
+        for created, chat_id in reversed(page):
+            session = self.sessions.get(chat_id)
+            if session is None:
+                continue
+            chats.append({
+                'id': chat_id,
+                'title': session['title'] or chat_title(None),
+                'created': created,
+                'message_count': len(session['messages'])
+            })
+        return chats
+
+    def _drop(self, chat_id):
+        """Remove a chat and its index entry; returns False if it did not exist"""
+        with self._lock:
+            session = self.sessions.pop(chat_id, None)
+            if session is None:
+                return False
+            index = bisect.bisect_left(self._order, (session['created'], chat_id))
+            if index < len(self._order) and self._order[index][1] == chat_id:
+                del self._order[index]
+            return True
+
+    def delete(self, chat_id):
+        removed = self._drop(chat_id)
+        self.budget.discard(chat_id)
+        return removed
+
+    def expire(self):
+        removed = 0
+        for chat_id, reason in self.budget.victims():
+            if self._drop(chat_id):
+                removed += 1
+            self.budget.discard(chat_id, reason)
+        return removed
+
+    def count(self):
+        return len(self.sessions)
+
+class SQLiteChatStore(ChatStore):
+    """
+    SQLite backend in WAL mode, shared by every worker on the host
+    
+    Messages are append-only rows indexed on (chat_id, created). Writes are
+    queued and committed in batches by a single writer thread; reads flush
+    first so a request always sees its own writes. A flush makes the writer
+    commit right away and waits only for writes queued before it. Each
+    thread uses its own connection.
+    """
 
-1. **🚨 一次一问**：每个回复只能问一个问题，只能有一个DRAWING_OPTIONS块
-2. **自然流畅**：像朋友聊天一样自然，但必须在需要选择时输出正确的DRAWING_OPTIONS格式
-3. **智能判断**：根据用户的回复判断下一步该问什么
-4. **随时可画**：用户随时可以开始绘画，不强求选完所有维度
-5. **记忆完整**：分析时要考虑整个对话的所有信息
-6. **避免重复**：不要重复询问用户已经明确的内容
-7. **耐心引导**：不要急于收集所有信息，一步一步来
-6. **格式规范**：绝对不要在回复中使用代码块符号（```），避免触发前端代码区显示
+    def __init__(self, path, batch_size=100, flush_interval=0.05):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._local = os_thread_local()
+        self._writes = queue.Queue()
+        self._init_schema()
+        self._writer = Thread(target=self._write_loop, name='chat-store-writer', daemon=True)
+        self._writer.start()
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA busy_timeout=30000')
+            self._local.conn = conn
+        return conn
+
+    def _init_schema(self):
+        conn = self._connect()
+        conn.executescript('''
+            CREATE TABLE IF NOT EXISTS chats (
+                chat_id TEXT PRIMARY KEY,
+                created REAL NOT NULL,
+                title TEXT,
+                message_count INTEGER NOT NULL DEFAULT 0,
+                summary TEXT,
+                summary_upto INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id TEXT NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL,
+                created REAL NOT NULL,
+                tokens INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS idx_messages_chat_created ON messages (chat_id, created);
+        ''')
+        columns = {row[1] for row in conn.execute('PRAGMA table_info(chats)')}
+        if 'title' not in columns:
+            # 旧数据库：补充标题和消息数列，并从已有消息回填
+            conn.executescript('''
+                ALTER TABLE chats ADD COLUMN title TEXT;
+                ALTER TABLE chats ADD COLUMN message_count INTEGER NOT NULL DEFAULT 0;
+                UPDATE chats SET message_count = (SELECT COUNT(*) FROM messages m WHERE m.chat_id = chats.chat_id);
+            ''')
+            rows = conn.execute('''
+                SELECT c.chat_id, (SELECT content FROM messages m WHERE m.chat_id = c.chat_id AND m.role = 'user'
+                                   ORDER BY m.created, m.id LIMIT 1)
+                FROM chats c
+            ''').fetchall()
+            conn.executemany(
+                'UPDATE chats SET title = ? WHERE chat_id = ?',
+                [(chat_title(first_user), chat_id) for chat_id, first_user in rows if first_user]
+            )
+        if 'summary' not in columns:
+            conn.executescript('''
+                ALTER TABLE chats ADD COLUMN summary TEXT;
+                ALTER TABLE chats ADD COLUMN summary_upto INTEGER NOT NULL DEFAULT 0;
+            ''')
+        if 'tokens' not in {row[1] for row in conn.execute('PRAGMA table_info(messages)')}:
+            # 旧消息的token数在首次读取时补算
+            conn.execute('ALTER TABLE messages ADD COLUMN tokens INTEGER')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_chats_created ON chats (created, chat_id)')
+
+    def _write_loop(self):
+        conn = self._connect()
+        while True:
+            batch = [self._writes.get()]
+            flushes = []
+            deadline = time.time() + self.flush_interval
+            # 读请求在等待时立即提交，不再等满批量窗口
+            while len(batch) < self.batch_size and not isinstance(batch[-1], threading.Event):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._writes.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            writes = []
+            for item in batch:
+                (flushes if isinstance(item, threading.Event) else writes).append(item)
+            try:
+                if writes:
+                    conn.execute('BEGIN IMMEDIATE')
+                    for sql, params in writes:
+                        conn.execute(sql, params)
+                    conn.execute('COMMIT')
+            except Exception as e:
+                logger.error(f"Chat store write failed: {e}")
+                try:
+                    conn.execute('ROLLBACK')
+                except Exception:
+                    pass
+            finally:
+                for flushed in flushes:
+                    flushed.set()
+
+    def _write(self, sql, params):
+        self._writes.put((sql, params))
+
+    def flush(self):
+        """Commit now and wait until every write queued before this call is committed"""
+        flushed = threading.Event()
+        self._writes.put(flushed)
+        flushed.wait()
+
+    def exists(self, chat_id):
+        self.flush()
+        row = self._connect().execute('SELECT 1 FROM chats WHERE chat_id = ?', (chat_id,)).fetchone()
+        return row is not None
+
+    def ensure(self, chat_id):
+        self._write('INSERT OR IGNORE INTO chats (chat_id, created) VALUES (?, ?)', (chat_id, time.time()))
+
+    def append_message(self, chat_id, role, content):
+        self.ensure(chat_id)
+        self._write(
+            'INSERT INTO messages (chat_id, role, content, created, tokens) VALUES (?, ?, ?, ?, ?)',
+            (chat_id, role, content, time.time(), estimate_tokens(content))
+        )
+        self._write(
+            'UPDATE chats SET message_count = message_count + 1, title = COALESCE(title, ?) WHERE chat_id = ?',
+            (chat_title(content) if role == 'user' else None, chat_id)
+        )
 
-**正确的对话流程示例：**
+    def get_messages(self, chat_id, limit=None):
+        self.flush()
+        conn = self._connect()
+        if limit:
+            rows = conn.execute(
+                'SELECT role, content FROM (SELECT id, role, content FROM messages WHERE chat_id = ? '
+                'ORDER BY created DESC, id DESC LIMIT ?) ORDER BY id',
+                (chat_id, limit)
+            ).fetchall()
+        else:
+            rows = conn.execute(
+                'SELECT role, content FROM messages WHERE chat_id = ? ORDER BY created, id',
+                (chat_id,)
+            ).fetchall()
+        return [{'role': role, 'content': content} for role, content in rows]
+
+    def get_info(self, chat_id):
+        self.flush()
+        row = self._connect().execute(
+            'SELECT created, title, message_count FROM chats WHERE chat_id = ?', (chat_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        created, title, count = row
+        return {'id': chat_id, 'title': title or chat_title(None), 'created': created, 'message_count': count}
+
+    def get_message_range(self, chat_id, before=None, since=None, limit=None):
+        self.flush()
+        conn = self._connect()
+        if since is not None:
+            sql = 'SELECT id, role, content, tokens FROM messages WHERE chat_id = ? AND id > ? ORDER BY id'
+            params = [chat_id, since]
+        else:
+            sql = 'SELECT id, role, content, tokens FROM messages WHERE chat_id = ?'
+            params = [chat_id]
+            if before is not None:
+                sql += ' AND id < ?'
+                params.append(before)
+            sql = f'SELECT * FROM ({sql} ORDER BY id DESC{" LIMIT ?" if limit else ""}) ORDER BY id'
+        if limit:
+            if since is not None:
+                sql += ' LIMIT ?'
+            params.append(limit)
+        messages = []
+        for message_id, role, content, tokens in conn.execute(sql, params).fetchall():
+            if tokens is None:
+                tokens = estimate_tokens(content)
+                self._write('UPDATE messages SET tokens = ? WHERE id = ?', (tokens, message_id))
+            messages.append({'id': message_id, 'role': role, 'content': content, 'tokens': tokens})
+        return messages
+
+    def get_summary(self, chat_id):
+        self.flush()
+        row = self._connect().execute(
+            'SELECT summary, summary_upto FROM chats WHERE chat_id = ?', (chat_id,)
+        ).fetchone()
+        return (row[0], row[1]) if row else (None, 0)
+
+    def set_summary(self, chat_id, summary, upto_id):
+        # 只向前推进，避免并发的摘要任务互相覆盖
+        self._write(
+            'UPDATE chats SET summary = ?, summary_upto = ? WHERE chat_id = ? AND summary_upto < ?',
+            (summary, upto_id, chat_id, upto_id)
+        )
 
-**第1轮对话：**
-- 用户："我想画赛博朋克未来城市"
-- AI："Cyberpunk style is so cool! Which color tone feeling do you prefer?
-  DRAWING_OPTIONS:Neon Purple-Blue - Primarily purple and blue tones|Colorful Neon - Multiple colors intertwined|Cool Tech Blue - Cool-toned technological feel|Dark Red Metal - Deep red with metallic texture"
+    def list_chats(self, limit=None, before=None):
+        self.flush()
+        sql = 'SELECT chat_id, created, title, message_count FROM chats'
+        params = []
+        if before:
+            sql += ' WHERE created < ? OR (created = ? AND chat_id < ?)'
+            params += [before[0], before[0], before[1]]
+        sql += ' ORDER BY created DESC, chat_id DESC'
+        if limit:
+            sql += ' LIMIT ?'
+            params.append(limit)
+        rows = self._connect().execute(sql, params).fetchall()
+        return [
+            {'id': chat_id, 'title': title or chat_title(None), 'created': created, 'message_count': count}
+            for chat_id, created, title, count in rows
+        ]
 
-**第2轮对话：**
-- 用户选择："霓虹紫蓝"
-- AI："Purple-blue tones really capture the cyberpunk feeling! What time background do you prefer?
-  DRAWING_OPTIONS:Midnight Neon - Bustling nightscape at midnight|Dusk Glow - City silhouette at sunset|Rainy Night Reflections - Neon reflections in rainwater|Dawn Mist - City looming in morning fog"
+    def delete(self, chat_id):
+        if not self.exists(chat_id):
+            return False
+        self._write('DELETE FROM messages WHERE chat_id = ?', (chat_id,))
+        self._write('DELETE FROM chats WHERE chat_id = ?', (chat_id,))
+        self.flush()
+        return True
 
-**第3轮对话：**
-- 用户选择："深夜霓虹"，或者直接说"开始画吧" → 立即生成meta prompt并开始
+    def count(self):
+        self.flush()
+        return self._connect().execute('SELECT COUNT(*) FROM chats').fetchone()[0]
 
-**⚠️ 关键：每轮只问一个问题，等用户回复后再继续！绝对不能一次问多个问题！**
+def create_chat_store():
+    """Build the chat store selected by CHAT_STORE"""
+    if CHAT_STORE == 'sqlite':
+        logger.info(f"Using SQLite chat store: {CHAT_DB_PATH}")
+        return SQLiteChatStore(CHAT_DB_PATH, CHAT_DB_BATCH_SIZE, CHAT_DB_FLUSH_INTERVAL)
+    return MemoryChatStore(CHAT_SESSION_TTL, CHAT_MAX_SESSIONS, CHAT_MAX_BYTES)
 
-**完整示例 - 用户说"我想画一只可爱的小猫"时的正确回复：**
-```
-Kittens are so adorable! What kind of feeling do you want to create?
+chat_store = create_chat_store()
 
-DRAWING_OPTIONS:Fluffy Realistic - High-definition photographic level real kitten, detailed fur texture, warm natural lighting|Adorable Cartoon - Cute anime style kitten, big eyes and round face, vibrant colors|Elegant Oil Painting - Classical painting style elegant kitten, thick brushstrokes, artistic atmosphere|Fresh Watercolor - Transparent watercolor effect kitten, soft colors, beautiful mood
-```
+state_janitor = StateJanitor(STATE_JANITOR_INTERVAL)
+state_janitor.register('chats', chat_store)
+state_janitor.register('image_tasks', task_registry)
+state_janitor.start()
 
-## 🎯 **示例响应模式**
+class ChatContextBuilder:
+    """
+    Builds the message list for /api/chat within a token budget
+    
+    The newest messages are kept verbatim while they fit in the history
+    budget (the latest message is always kept). Older messages are
+    represented by a running summary stored with the chat. When messages fall
+    out of the window and are not yet in the summary, a background job folds
+    them in; requests never wait for it and use the last stored summary.
+    """
 
-**阶段1示例 - 当用户说"我确认选择：动漫插画。请根据我之前的所有选择，生成一个完整详细的绘画提示词描述，并提供开始绘画的选项。"：**
+    def __init__(self, store, token_budget, max_messages, summary_model, summary_batch=20, workers=2):
+        self.store = store
+        self.token_budget = token_budget
+        self.max_messages = max_messages
+        self.summary_model = summary_model
+        self.summary_batch = summary_batch
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='chat-summary')
+        self._lock = threading.Lock()
+        self._summarizing = set()
+        self.builds = 0
+        self.context_tokens = 0
+        self.max_context_tokens = 0
+        self.dropped_messages = 0
+        self.summaries = 0
+        self.summarized_messages = 0
+        self.summary_failures = 0
+
+    def build(self, chat_id, system_messages):
+        """system_messages followed by the summary (if any) and the recent history"""
+        history = self.store.get_message_range(chat_id, limit=self.max_messages)
+        summary, summary_upto = self.store.get_summary(chat_id)
+        budget = self.token_budget - (estimate_tokens(summary) if summary else 0)
+
+        # 从最新消息往前取，直到超出预算
+        used = 0
+        start = len(history)
+        while start > 0 and (start == len(history) or used + history[start - 1]['tokens'] <= budget):
+            start -= 1
+            used += history[start]['tokens']
+        recent = history[start:]
+
+        messages = list(system_messages)
+        if summary:
+            messages.append({
+                'role': 'system',
+                'content': f"Summary of the earlier conversation (the user's choices in it still apply):\n{summary}"
+            })
+        messages.extend({'role': m['role'], 'content': m['content']} for m in recent)
+
+        # 窗口外还有未摘要的消息时在后台补充摘要
+        dropped = self._newest_dropped(chat_id, history, start)
+        if dropped is not None and dropped > summary_upto:
+            self._schedule_summary(chat_id, recent[0]['id'])
+
+        with self._lock:
+            self.builds += 1
+            self.context_tokens += used
+            self.max_context_tokens = max(self.max_context_tokens, used)
+            self.dropped_messages += start
+        return messages
+
+    def _newest_dropped(self, chat_id, history, start):
+        """Id of the newest message left out of the context window, or None"""
+        if start > 0:
+            return history[start - 1]['id']
+        if len(history) == self.max_messages:
+            older = self.store.get_message_range(chat_id, before=history[0]['id'], limit=1)
+            return older[0]['id'] if older else None
+        return None
+
+    def _schedule_summary(self, chat_id, until_id):
+        with self._lock:
+            if chat_id in self._summarizing:
+                return
+            self._summarizing.add(chat_id)
+        self._executor.submit(self._summarize, chat_id, until_id)
+
+    def _summarize(self, chat_id, until_id):
+        """Fold messages with id < until_id into the chat's summary, a batch at a time"""
+        try:
+            summary, upto = self.store.get_summary(chat_id)
+            while True:
+                batch = [m for m in self.store.get_message_range(chat_id, since=upto, limit=self.summary_batch)
+                         if m['id'] < until_id]
+                if not batch:
+                    break
+                transcript = '\n\n'.join(f"{m['role']}: {m['content']}" for m in batch)
+                started = time.time()
+                response = get_qwen_client().chat.completions.create(
+                    model=self.summary_model,
+                    messages=prompt_templates.messages('chat_summary', {
+                        'role': 'user',
+                        'content': f"Previous summary:\n{summary or '(none)'}\n\nNew messages:\n{transcript}"
+                    }),
+                    temperature=0.3
+                )
+                prompt_templates.record('chat_summary', time.time() - started, response.usage)
+                summary = response.choices[0].message.content.strip()
+                upto = batch[-1]['id']
+                self.store.set_summary(chat_id, summary, upto)
+                with self._lock:
+                    self.summaries += 1
+                    self.summarized_messages += len(batch)
+        except Exception as e:
+            with self._lock:
+                self.summary_failures += 1
+            logger.error(f"Chat summary failed for {chat_id}: {e}")
+        finally:
+            with self._lock:
+                self._summarizing.discard(chat_id)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'token_budget': self.token_budget,
+                'builds': self.builds,
+                'avg_context_tokens': round(self.context_tokens / self.builds) if self.builds else 0,
+                'max_context_tokens': self.max_context_tokens,
+                'dropped_messages': self.dropped_messages,
+                'summarizing': len(self._summarizing),
+                'summaries': self.summaries,
+                'summarized_messages': self.summarized_messages,
+                'summary_failures': self.summary_failures
+            }
 
-Alright! Based on our conversation, I've organized your complete drawing requirements:
+chat_context = ChatContextBuilder(
+    chat_store, CHAT_HISTORY_TOKEN_BUDGET, CHAT_CONTEXT_MAX_MESSAGES,
+    CHAT_SUMMARY_MODEL, CHAT_SUMMARY_BATCH, CHAT_SUMMARY_WORKERS
+)
 
-**User Core Requirements:**
-User wants to draw a cute cat using anime illustration style
+def ask_qwen_stream(messages, model="qwen-plus", template=None):
+    """
+    Send messages to Qwen and return streaming response generator
+    
+    Args:
+        messages: Message list
+        model: Model to use, defaults to qwen-plus
+        template: Name of the prompt template the messages start with, for usage stats
+        
+    Yields:
+        Streaming response data
+    """
+    client = get_qwen_client()
+    
+    try:
+        # Call Qwen API with streaming response enabled
+        started = time.time()
+        stream = client.chat.completions.create(
+            model=model,
+            messages=messages,
+            stream=True,
+            stream_options={'include_usage': True}
+        )
+        
+        # Process streaming response
+        usage = None
+        try:
+            for chunk in stream:
+                # 最后一个chunk只携带usage，没有choices
+                if chunk.usage is not None:
+                    usage = chunk.usage
+                if not chunk.choices:
+                    continue
+                content = chunk.choices[0].delta.content
+                if content:
+                    yield content
+        finally:
+            # 调用方提前关闭（客户端断开）时立即关闭上游连接，不再读取剩余的生成内容
+            stream.close()
+        
+        if template:
+            prompt_templates.record(template, time.time() - started, usage)
+                
+    except Exception as e:
+        logger.error(f"Qwen API call failed: {e}")
+        yield f"Sorry, AI service is temporarily unavailable. Error message: {str(e)}"
 
-**Definite Requirements (must remain consistent):**
-- Subject Content: A cute cat
-- Art Style: Anime illustration style, big eyes, round face, vibrant colors
+def coalesce_chunks(chunks, flush_bytes, flush_interval):
+    """
+    Merge streamed text chunks into larger pieces
+    
+    A piece is emitted once it holds flush_bytes bytes or flush_interval
+    seconds have passed since the previous piece, whichever comes first;
+    whatever is left is emitted when the stream ends. chunks is read on a
+    separate thread so buffered text is flushed on time even while the
+    model pauses. Closing this generator stops the reader, which closes
+    chunks before it reads another chunk.
+    """
+    received = queue.Queue()
+    stopped = threading.Event()
+    end = object()
+    
+    def read():
+        try:
+            for chunk in chunks:
+                if stopped.is_set():
+                    break
+                received.put(chunk)
+        except Exception as e:
+            received.put(e)
+        finally:
+            chunks.close()
+            received.put(end)
+    
+    Thread(target=read, name='chat-stream-reader', daemon=True).start()
+    pending = []
+    size = 0
+    last_flush = time.time()
+    try:
+        while True:
+            # 有待发送内容时最多等到刷新时间点，否则等待下一个chunk
+            timeout = max(0, last_flush + flush_interval - time.time()) if pending else None
+            try:
+                chunk = received.get(timeout=timeout)
+            except queue.Empty:
+                chunk = None
+            if chunk is end:
+                break
+            if isinstance(chunk, Exception):
+                raise chunk
+            if chunk is not None:
+                pending.append(chunk)
+                size += len(chunk.encode('utf-8'))
+            now = time.time()
+            if pending and (size >= flush_bytes or now - last_flush >= flush_interval):
+                yield ''.join(pending)
+                pending = []
+                size = 0
+                last_flush = now
+        if pending:
+            yield ''.join(pending)
+    finally:
+        stopped.set()
+
+class ChatStreamStats:
+    """Frame counters for /api/chat streams"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.responses = 0
+        self.frames = 0
+        self.bytes = 0
+        self.cancelled = 0
+
+    def record(self, frames, frame_bytes, cancelled=False):
+        with self._lock:
+            self.responses += 1
+            self.frames += frames
+            self.bytes += frame_bytes
+            if cancelled:
+                self.cancelled += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'flush_bytes': CHAT_STREAM_FLUSH_BYTES,
+                'flush_ms': CHAT_STREAM_FLUSH_MS,
+                'responses': self.responses,
+                'cancelled': self.cancelled,
+                'frames_per_response': round(self.frames / self.responses, 1) if self.responses else 0,
+                'bytes_per_frame': round(self.bytes / self.frames, 1) if self.frames else 0
+            }
 
-**Variable Requirements (for diverse creation):**
-- Variations in expressions and actions
-- Different background environments  
-- Diverse color combinations
+chat_stream_stats = ChatStreamStats()
 
-**English Base Description:**
-A cute cat in anime illustration style, with big eyes and round face, colorful and vibrant
+def prompt_words(text):
+    """Lower-cased word set used to match a speculative prompt against the one the client sends"""
+    return set(re.findall(r'\w+', text.lower()))
 
-DRAWING_FINAL:Start Drawing
+class SpeculativeDiversifier:
+    """
+    Diversifies a drawing prompt before the user asks for images
+    
+    When a chat reply streams out DRAWING_FINAL:, the text before the marker
+    is what the frontend will later send to /api/generate_images, so a
+    streaming diversification is started right away and keyed to the chat.
+    The client sends the rendered text, which loses some markdown, so a
+    claim matches on word overlap rather than exact text. Results nobody
+    claims within ttl are dropped.
+    
+    A claim yields each speculated prompt as soon as it is parsed. If the
+    speculation has not produced all four prompts within `wait` seconds of
+    the claim, on_timeout decides: 'wait' keeps following it for up to
+    max_wait seconds in total, 'discard' gives up right away. A discarded
+    speculation is closed and the remaining prompts come from a fresh
+    stream. Speculation is per process: a claim that lands on another
+    worker misses.
+    """
 
-**阶段2示例 - 当用户单独说"开始绘画"时，直接开始，不再生成任何文本！**
+    def __init__(self, enabled, ttl, wait, min_overlap, workers=2, on_timeout='wait', max_wait=60):
+        self.enabled = enabled
+        self.ttl = ttl
+        self.wait = wait
+        self.min_overlap = min_overlap
+        self.on_timeout = on_timeout
+        self.max_wait = max(wait, max_wait) if on_timeout == 'wait' else wait
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='speculative-diversify')
+        self._lock = threading.Lock()
+        self._entries = {}
+        self.started = 0
+        self.hits = 0
+        self.mismatches = 0
+        self.slow = 0
+        self.timeouts = 0
+        self.expired = 0
+
+    def start(self, chat_id, base_prompt):
+        """Begin diversifying base_prompt for chat_id, replacing any earlier speculation"""
+        if not self.enabled or not base_prompt:
+            return
+        entry = {
+            'base_prompt': base_prompt,
+            'started': time.time(),
+            'prompts': [],
+            'done': False,
+            'cancelled': False,
+            'cond': threading.Condition()
+        }
+        entry['future'] = self._executor.submit(self._run, entry)
+        with self._lock:
+            self._expire()
+            previous = self._entries.get(chat_id)
+            if previous:
+                self._cancel(previous)
+            self._entries[chat_id] = entry
+            self.started += 1
+        logger.info(f"Started speculative diversification for chat {chat_id}")
+
+    def _run(self, entry):
+        """Stream the diversification into entry['prompts'] until done or cancelled"""
+        prompts = stream_diverse_prompts(entry['base_prompt'])
+        try:
+            for prompt in prompts:
+                with entry['cond']:
+                    if entry['cancelled']:
+                        break
+                    entry['prompts'].append(prompt)
+                    entry['cond'].notify_all()
+        finally:
+            # 被放弃时关闭流式生成，释放上游连接
+            prompts.close()
+            with entry['cond']:
+                entry['done'] = True
+                entry['cond'].notify_all()
+
+    @staticmethod
+    def _cancel(entry):
+        entry['future'].cancel()
+        with entry['cond']:
+            entry['cancelled'] = True
+            entry['cond'].notify_all()
+
+    def claim(self, chat_id, base_prompt):
+        """Iterator over four prompts for base_prompt if a matching speculation exists, else None"""
+        with self._lock:
+            self._expire()
+            entry = self._entries.pop(chat_id, None)
+        if entry is None:
+            return None
+        speculated = prompt_words(entry['base_prompt'])
+        requested = prompt_words(base_prompt)
+        overlap = len(speculated & requested) / max(len(speculated), len(requested), 1)
+        if overlap < self.min_overlap:
+            self._cancel(entry)
+            with self._lock:
+                self.mismatches += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        logger.info(f"Using speculative diversification for chat {chat_id}")
+        return self._follow(chat_id, entry, base_prompt)
+
+    def _next_prompt(self, entry, index, deadline):
+        """Prompt number index once parsed; None if the speculation ended or deadline passed first"""
+        with entry['cond']:
+            while len(entry['prompts']) <= index and not entry['done']:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                entry['cond'].wait(remaining)
+            return entry['prompts'][index] if len(entry['prompts']) > index else None
+
+    def _follow(self, chat_id, entry, base_prompt):
+        claimed = time.time()
+        deadline = claimed + self.wait
+        count = 0
+        rest = None
+        try:
+            while count < 4:
+                prompt = self._next_prompt(entry, count, deadline)
+                if prompt is None and not entry['done'] and deadline < claimed + self.max_wait:
+                    # 推测调用已在进行中，继续等待通常比重新生成更快
+                    with self._lock:
+                        self.slow += 1
+                    logger.warning(f"Speculative diversification for chat {chat_id} still running after {self.wait}s, waiting")
+                    deadline = claimed + self.max_wait
+                    prompt = self._next_prompt(entry, count, deadline)
+                if prompt is None:
+                    break
+                yield prompt
+                count += 1
+            if count < 4:
+                if not entry['done']:
+                    with self._lock:
+                        self.timeouts += 1
+                    logger.warning(f"Discarding speculative diversification for chat {chat_id} after {count} prompts")
+                self._cancel(entry)
+                rest = stream_diverse_prompts(base_prompt)
+                for prompt in rest:
+                    if count >= 4:
+                        break
+                    yield prompt
+                    count += 1
+        finally:
+            if rest is not None:
+                rest.close()
+
+    def discard(self, chat_id):
+        with self._lock:
+            entry = self._entries.pop(chat_id, None)
+        if entry:
+            self._cancel(entry)
+
+    def _expire(self):
+        """Drop unclaimed entries older than ttl; must be called with the lock held"""
+        cutoff = time.time() - self.ttl
+        for chat_id in [key for key, entry in self._entries.items() if entry['started'] < cutoff]:
+            self._cancel(self._entries.pop(chat_id))
+            self.expired += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'pending': len(self._entries),
+                'started': self.started,
+                'hits': self.hits,
+                'mismatches': self.mismatches,
+                'slow': self.slow,
+                'timeouts': self.timeouts,
+                'expired': self.expired,
+                'on_timeout': self.on_timeout
+            }
 
-**⚠️ 关键区别：确认选择阶段要生成总结+按钮，开始绘画阶段要直接开始！**
+speculative_diversifier = SpeculativeDiversifier(
+    SPECULATIVE_DIVERSIFY, SPECULATIVE_TTL, SPECULATIVE_WAIT, SPECULATIVE_MIN_OVERLAP, SPECULATIVE_WORKERS,
+    SPECULATIVE_ON_TIMEOUT, SPECULATIVE_MAX_WAIT
+)
+
+@app.after_request
+def record_image_access(response):
+    """Feed generated image accesses into the image store's LRU"""
+    if response.status_code == 200 and request.path.startswith('/' + IMAGE_STORE_ROOT.replace(os.sep, '/') + '/'):
+        # 只记录存储目录内的真实文件，防止../之类的路径修改目录外文件的mtime
+        path = os.path.realpath(request.path.lstrip('/'))
+        if path.startswith(os.path.realpath(IMAGE_STORE_ROOT) + os.sep):
+            image_store.touch(os.path.relpath(path))
+    return response
 
-## 🚨 **最终提醒**
-- **绝对禁止在一个回复中问多个问题**
-- **每个回复最多只能有一个DRAWING_OPTIONS块**
-- **一次一问，等用户回复后再继续**
-- **不要急于收集所有信息，要有耐心！**'''
-            }
-        ]
+@app.route('/')
+def index():
+    """Homepage route"""
+    return render_template('index.html')
+
+@app.route('/api/chat', methods=['POST'])
+def chat():
+    """Handle chat requests"""
+    try:
+        data = request.json
+        message = data.get('message', '').strip()
+        chat_id = data.get('chat_id', 'default')
+        
+        if not message:
+            return jsonify({'error': 'Message cannot be empty'}), 400
         
-        # 添加历史对话（保留最近10轮对话）
-        recent_messages = session['messages'][-20:]  # 最近20条消息（10轮对话）
-        messages.extend(recent_messages)
+        # Add user message to session history (creates the chat if needed)
+        chat_store.append_message(chat_id, 'user', message)
+        
+        # 系统提示词在前（字节稳定前缀），之后是token预算内的历史对话，更早的对话以摘要形式提供
+        messages = chat_context.build(chat_id, prompt_templates.messages('chat_system'))
         
         def generate_response():
             """生成流式响应"""
+            parts = []
+            frames = 0
+            frame_bytes = 0
+            # 获取AI流式响应，合并为较大的帧（关闭时由coalesce_chunks关闭上游流）
+            pieces = coalesce_chunks(
+                ask_qwen_stream(messages, template='chat_system'),
+                CHAT_STREAM_FLUSH_BYTES, CHAT_STREAM_FLUSH_MS / 1000
+            )
+            speculated = False
+            tail = ''
             try:
-                full_response = ""
-                
-                # 获取AI流式响应
-                for content in ask_qwen_stream(messages):
-                    full_response += content
+                for content in pieces:
+                    parts.append(content)
+                    # 回复中出现DRAWING_FINAL时，用标记前的内容提前开始多样化（标记可能跨帧）
+                    if not speculated and 'DRAWING_FINAL:' in tail + content:
+                        speculated = True
+                        speculative_diversifier.start(chat_id, ''.join(parts).split('DRAWING_FINAL:')[0].strip())
+                    tail = (tail + content)[-len('DRAWING_FINAL:'):]
                     # 返回SSE格式的数据
-                    yield f"data: {json.dumps({'content': content})}\n\n"
+                    frame = f"data: {json.dumps({'content': content})}\n\n"
+                    frames += 1
+                    frame_bytes += len(frame)
+                    yield frame
+                chat_stream_stats.record(frames, frame_bytes)
                 
-                # 将AI响应添加到会话历史
-                session['messages'].append({
-                    'role': 'assistant', 
-                    'content': full_response
-                })
+                # 将AI响应添加到会话历史，结束前提交，下一条消息落到其他worker时顺序不会颠倒
+                chat_store.append_message(chat_id, 'assistant', ''.join(parts))
+                chat_store.flush()
                 
                 # 发送结束信号
                 yield f"data: [DONE]\n\n"
                 
+            except GeneratorExit:
+                # 客户端断开：不保存不完整的回复，关闭上游流释放连接
+                logger.info(f"Client disconnected from chat {chat_id} after {frames} frames")
+                chat_stream_stats.record(frames, frame_bytes, cancelled=True)
+                raise
             except Exception as e:
                 logger.error(f"Error generating response: {e}")
                 error_msg = f"Sorry, an error occurred while processing your request: {str(e)}"
                 yield f"data: {json.dumps({'content': error_msg})}\n\n"
                 yield f"data: [DONE]\n\n"
+            finally:
+                pieces.close()
         
         # 返回流式响应
         return Response(
@@ -839,6 +3562,14 @@ def generate_images():
         data = request.json
         base_prompt = data.get('prompt', '').strip()
         chat_id = data.get('chat_id', 'default')
+        fresh = bool(data.get('fresh', False))  # 跳过缓存，生成新的多样化prompts
+        seed = data.get('seed')
+        options = None
+        if seed is not None:
+            try:
+                options = {'seed': int(seed)}  # 固定seed时结果可复用
+            except (TypeError, ValueError):
+                return jsonify({'error': 'Seed must be an integer'}), 400
         
         # 添加调试日志
         logger.info(f"Received image generation request - Chat ID: {chat_id}")
@@ -847,141 +3578,258 @@ def generate_images():
         if not base_prompt:
             return jsonify({'error': 'Prompt cannot be empty'}), 400
         
-        # 创建任务ID
-        task_id = str(uuid.uuid4())
-        
-        # 生成四个不同的prompts
-        logger.info("Generating four diversified prompts...")
-        diverse_prompts = generate_diverse_prompts(base_prompt)
-        logger.info(f"Generated diverse prompts: {diverse_prompts}")
+        # 准入控制：队列已满时直接拒绝，不再调用LLM
+        try:
+            image_generation_pool.admit()
+        except PoolSaturated as e:
+            logger.warning(f"Image generation rejected, retry after {e.retry_after}s")
+            response = jsonify({'error': str(e), 'retry_after': e.retry_after})
+            response.headers['Retry-After'] = str(e.retry_after)
+            return response, 429
         
-        # 初始化任务状态，每张图片保存对应的prompt
-        image_generation_tasks[task_id] = {
-            'status': 'pending',
-            'base_prompt': base_prompt,
-            'chat_id': chat_id,
-            'created': time.time(),
-            'images': [
-                {'status': 'pending', 'url': None, 'error': None, 'prompt': diverse_prompts[i]} 
-                for i in range(4)
-            ]
-        }
+        try:
+            # 创建任务ID
+            task_id = str(uuid.uuid4())
+            
+            # 初始化任务状态，每张图片的prompt在后台确定后再填入
+            task_registry.create(task_id, {
+                'status': 'pending',
+                'base_prompt': base_prompt,
+                'chat_id': chat_id,
+                'created': time.time(),
+                'version': 0,
+                'images': [
+                    {'status': 'pending', 'url': None, 'error': None, 'prompt': None}
+                    for i in range(4)
+                ]
+            })
+        except Exception:
+            image_generation_pool.release()
+            raise
         
-        # 创建一个后台线程来间隔提交四个图片生成任务
-        def submit_tasks_with_delay():
-            """Submit four image generation tasks with intervals to avoid API conflicts"""
-            for i in range(4):
-                # 使用对应的多样化prompt
-                prompt = diverse_prompts[i]
-                logger.info(f"Submitting generation task for image {i+1}, prompt: {prompt}")
-                
-                # 在后台线程中启动单个图片生成任务
-                thread = Thread(target=generate_single_image, args=(task_id, i, prompt))
-                thread.daemon = True
-                thread.start()
-                
-                # 如果不是最后一个任务，等待一段时间再提交下一个
-                if i < 3:
-                    time.sleep(3)  # 间隔3秒提交下一个任务
+        def submit_task_images():
+            """Submit each image as soon as its prompt is known; pacing is done by liblib_submit_limiter"""
+            # 聊天回复时已开始的推测可直接跟随；否则流式生成。两者都是每解析出一个prompt就提交
+            prompts = None if fresh else speculative_diversifier.claim(chat_id, base_prompt)
+            if prompts is None:
+                prompts = stream_diverse_prompts(base_prompt, fresh=fresh)
+            try:
+                for i, prompt in enumerate(prompts):
+                    if i >= 4 or is_task_cancelled(task_id):
+                        return
+                    update_image_state(task_id, i, prompt=prompt)
+                    # 使用对应的多样化prompt
+                    logger.info(f"Submitting generation task for image {i+1}, prompt: {prompt}")
+                    generate_single_image(task_id, i, prompt, options=options)
+            finally:
+                # 取消时关闭流式生成，释放上游连接
+                prompts.close()
         
-        # 启动任务提交线程
-        submit_thread = Thread(target=submit_tasks_with_delay)
-        submit_thread.daemon = True
-        submit_thread.start()
+        # 在有界线程池中提交任务
+        image_generation_pool.submit(submit_task_images)
             
         return jsonify({
             'task_id': task_id,
             'status': 'started',
             'message': 'Image generation task started',
-            'diverse_prompts': diverse_prompts  # 返回生成的多样化prompts供调试
+            'diverse_prompts': None  # prompts在后台生成，见任务状态中各图片的prompt
         })
         
     except Exception as e:
         logger.error(f"Image generation API error: {e}")
         return jsonify({'error': 'Internal server error'}), 500
 
+@app.route('/api/generate_images/queue', methods=['GET'])
+def get_generation_queue():
+    """Image generation pool introspection"""
+    return jsonify(image_generation_pool.stats())
+
 @app.route('/api/generate_images/<task_id>', methods=['GET'])
 def get_generation_status(task_id):
-    """Get image generation status"""
+    """
+    Get image generation status
+    
+    Responses carry the task version as ETag; If-None-Match with the current
+    version returns 304. With ?wait=<seconds> the request blocks until the
+    version changes (or the timeout passes) before answering.
+    """
     try:
-        if task_id not in image_generation_tasks:
+        task = task_registry.get(task_id)
+        if task is None:
             return jsonify({'error': 'Task not found'}), 404
         
-        task = image_generation_tasks[task_id]
+        # 客户端已知的版本：If-None-Match优先，其次是?version=
+        known_version = None
+        for tag in request.if_none_match.as_set():
+            if tag.isdigit():
+                known_version = int(tag)
+                break
+        if known_version is None and request.args.get('version', '').isdigit():
+            known_version = int(request.args['version'])
         
-        # 计算整体状态
-        all_completed = all(img['status'] == 'completed' for img in task['images'])
-        any_failed = any(img['status'] == 'failed' for img in task['images'])
-        any_generating = any(img['status'] == 'generating' for img in task['images'])
+        wait = min(request.args.get('wait', 0, type=float), TASK_LONG_POLL_MAX)
+        if wait > 0 and known_version is not None:
+            task = wait_for_task_version(task_id, known_version, wait)
+            if task is None:
+                return jsonify({'error': 'Task not found'}), 404
         
-        if all_completed:
-            overall_status = 'completed'
-        elif any_failed and not any_generating:
-            overall_status = 'failed'
-        elif any_generating:
-            overall_status = 'generating'
+        version = task.get('version', 0)
+        if request.if_none_match.contains(str(version)):
+            response = Response(status=304)
         else:
-            overall_status = 'pending'
-        
-        return jsonify({
-            'task_id': task_id,
-            'status': overall_status,
-            'base_prompt': task.get('base_prompt', task.get('prompt', '')),  # 兼容旧格式
-            'chat_id': task['chat_id'],
-            'created': task['created'],
-            'images': task['images']  # 现在包含每张图片的prompt信息
-        })
+            response = jsonify(build_task_status(task_id, task))
+        response.set_etag(str(version))
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
         
     except Exception as e:
         logger.error(f"Error getting generation status: {e}")
         return jsonify({'error': 'Internal server error'}), 500
 
+@app.route('/api/generate_images/<task_id>', methods=['DELETE'])
+def cancel_generation(task_id):
+    """Cancel an image generation task; finished images are kept"""
+    if not cancel_image_task(task_id):
+        return jsonify({'error': 'Task not found'}), 404
+    
+    task = task_registry.get(task_id)
+    return jsonify(build_task_status(task_id, task) if task else {'task_id': task_id, 'status': 'cancelled'})
+
+@app.route('/api/generate_images/<task_id>/events', methods=['GET'])
+def stream_generation_events(task_id):
+    """Push image generation status as Server-Sent Events whenever an image changes state"""
+    if task_registry.get(task_id) is None:
+        return jsonify({'error': 'Task not found'}), 404
+    
+    # 先订阅再发送快照，避免遗漏两者之间的状态变化
+    events = subscribe_task_events(task_id)
+    # 共享注册表时其他worker的更新不会推送到本进程，定期重新读取
+    wait_interval = min(TASK_EVENT_KEEPALIVE, TASK_REGISTRY_POLL_INTERVAL) if task_registry.shared else TASK_EVENT_KEEPALIVE
+    
+    def generate_events():
+        try:
+            task = task_registry.get(task_id)
+            if task is None:
+                return
+            payload = build_task_status(task_id, task)
+            yield f"data: {json.dumps(payload)}\n\n"
+            last_sent = time.time()
+            
+            while not is_task_finished(payload):
+                try:
+                    update = events.get(timeout=wait_interval)
+                except queue.Empty:
+                    task = task_registry.peek(task_id)
+                    if task is None:
+                        break
+                    update = build_task_status(task_id, task)
+                    if [img['status'] for img in update['images']] == [img['status'] for img in payload['images']]:
+                        if time.time() - last_sent >= TASK_EVENT_KEEPALIVE:
+                            # 心跳注释，防止代理断开空闲连接
+                            yield ": keepalive\n\n"
+                            last_sent = time.time()
+                        continue
+                payload = update
+                yield f"data: {json.dumps(payload)}\n\n"
+                last_sent = time.time()
+        finally:
+            unsubscribe_task_events(task_id, events)
+    
+    return Response(
+        generate_events(),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'Connection': 'keep-alive',
+            'X-Accel-Buffering': 'no',
+            'Access-Control-Allow-Origin': '*',
+        }
+    )
+
+def encode_chat_cursor(chat):
+    """Opaque pagination cursor pointing just past the given chat"""
+    return base64.urlsafe_b64encode(json.dumps([chat['created'], chat['id']]).encode()).decode()
 
+def decode_chat_cursor(cursor):
+    """(created, chat_id) from a cursor; raises ValueError if malformed"""
+    try:
+        created, chat_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return float(created), str(chat_id)
+    except Exception:
+        raise ValueError('Invalid cursor')
 
 @app.route('/api/chats', methods=['GET'])
 def get_chats():
-    """Get all chat sessions"""
-    chats = []
-    for chat_id, session in chat_sessions.items():
-        chat_info = {
-            'id': chat_id,
-            'title': 'New Conversation',
-            'created': session['created'],
-            'message_count': len(session['messages'])
-        }
-        
-        # 如果有消息，用第一条用户消息作为标题
-        user_messages = [msg for msg in session['messages'] if msg['role'] == 'user']
-        if user_messages:
-            first_msg = user_messages[0]['content']
-            chat_info['title'] = first_msg[:30] + ('...' if len(first_msg) > 30 else '')
-        
-        chats.append(chat_info)
+    """
+    Get chat sessions, newest first
+    
+    Without parameters returns every chat as a list. With ?limit= and/or
+    ?cursor= returns one page: {'chats': [...], 'next_cursor': ...}.
+    """
+    if 'limit' not in request.args and 'cursor' not in request.args:
+        return jsonify(chat_store.list_chats())
+    
+    try:
+        limit = min(max(int(request.args.get('limit', CHAT_PAGE_SIZE)), 1), CHAT_PAGE_MAX)
+        cursor = request.args.get('cursor')
+        before = decode_chat_cursor(cursor) if cursor else None
+    except ValueError:
+        return jsonify({'error': 'Invalid limit or cursor'}), 400
     
-    # 按创建时间排序
-    chats.sort(key=lambda x: x['created'], reverse=True)
-    return jsonify(chats)
+    chats = chat_store.list_chats(limit=limit, before=before)
+    return jsonify({
+        'chats': chats,
+        'next_cursor': encode_chat_cursor(chats[-1]) if len(chats) == limit else None
+    })
 
 @app.route('/api/chats/<chat_id>', methods=['GET'])
 def get_chat(chat_id):
-    """Get specific chat session"""
-    if chat_id not in chat_sessions:
+    """
+    Get specific chat session
+    
+    Every message carries a stable id. ?limit=N returns the last N messages,
+    ?before=<id> pages older history and ?since=<id> returns only messages
+    newer than that id; has_more tells whether the range was cut by limit.
+    """
+    info = chat_store.get_info(chat_id)
+    if info is None:
         return jsonify({'error': 'Chat session not found'}), 404
     
-    session = chat_sessions[chat_id]
+    try:
+        before = int(request.args['before']) if 'before' in request.args else None
+        since = int(request.args['since']) if 'since' in request.args else None
+        limit = int(request.args['limit']) if 'limit' in request.args else None
+    except ValueError:
+        return jsonify({'error': 'before, since and limit must be integers'}), 400
+    if limit is not None and limit < 1 or before is not None and since is not None:
+        return jsonify({'error': 'limit must be positive and before/since are exclusive'}), 400
+    
+    # 多取一条判断是否还有更多消息
+    messages = chat_store.get_message_range(chat_id, before=before, since=since, limit=limit + 1 if limit else None)
+    has_more = bool(limit) and len(messages) > limit
+    if has_more:
+        messages = messages[:limit] if since is not None else messages[1:]
+    
     return jsonify({
         'id': chat_id,
-        'messages': session['messages'],
-        'created': session['created']
+        'title': info['title'],
+        'messages': messages,
+        'created': info['created'],
+        'message_count': info['message_count'],
+        'has_more': has_more
     })
 
 @app.route('/api/chats/<chat_id>', methods=['DELETE'])
 def delete_chat(chat_id):
     """Delete chat session"""
-    if chat_id not in chat_sessions:
+    if not chat_store.delete(chat_id):
         return jsonify({'error': 'Chat session not found'}), 404
     
-    del chat_sessions[chat_id]
+    # 停止该会话仍在进行的图片生成
+    speculative_diversifier.discard(chat_id)
+    for task_id in task_registry.task_ids(chat_id=chat_id):
+        cancel_image_task(task_id)
+    
     return jsonify({'message': 'Chat session deleted'})
 
 @app.route('/api/health', methods=['GET'])
@@ -990,7 +3838,24 @@ def health_check():
     return jsonify({
         'status': 'healthy',
         'timestamp': time.time(),
-        'active_chats': len(chat_sessions)
+        'server_mode': 'gevent' if gevent_patched() else 'threads',
+        'active_chats': chat_store.count(),
+        'image_tasks': task_registry.count(),
+        'qwen_client': qwen_client_pool.stats(),
+        'liblib_http': liblib_http.stats(),
+        'liblib_submit_limiter': liblib_submit_limiter.stats(),
+        'liblib_poller': liblib_poller.stats(),
+        'liblib_poll_schedule': liblib_poll_schedule.stats(),
+        'prompt_cache': prompt_cache.stats(),
+        'image_result_cache': image_result_cache.stats(),
+        'download_pipeline': download_pipeline.stats(),
+        'derivative_pipeline': derivative_pipeline.stats(),
+        'image_store': image_store.stats(),
+        'state_janitor': state_janitor.stats(),
+        'chat_context': chat_context.stats(),
+        'prompt_templates': prompt_templates.stats(),
+        'chat_stream': chat_stream_stats.stats(),
+        'speculative_diversifier': speculative_diversifier.stats()
     })
 
 @app.errorhandler(404)
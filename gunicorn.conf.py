@@ -0,0 +1,38 @@
+"""
+Gunicorn settings for CanvasFlow
+
+Defaults to gevent workers: every open SSE stream, long-poll and upstream
+LLM call is a greenlet, so slow chat streams do not block other requests
+and one worker can hold thousands of idle event streams. Set
+GUNICORN_WORKER_CLASS=sync (or gthread) to go back to thread-per-request.
+More than one worker is only started when chats and image tasks are
+stored in SQLite, since the in-memory stores are per process.
+"""
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+
+# 内存存储是进程内的：多个worker会各自持有聊天历史和任务状态，请求落到其他worker时会丢失历史或404。
+# 只有聊天和任务都使用sqlite时才启用多worker，单worker的并发由gevent提供
+shared_state = os.getenv("CHAT_STORE", "memory") == "sqlite" and os.getenv("IMAGE_TASK_STORE", "memory") == "sqlite"
+requested_workers = int(os.getenv("WEB_CONCURRENCY", "4"))
+workers = requested_workers if shared_state else 1
+
+
+def on_starting(server):
+    if workers < requested_workers:
+        server.log.warning(
+            f"Running 1 worker instead of {requested_workers}: set CHAT_STORE=sqlite and "
+            f"IMAGE_TASK_STORE=sqlite to share chats and image tasks across workers"
+        )
+
+
+# 异步worker：SSE和长轮询只占用一个greenlet
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gevent")
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "2000"))
+threads = int(os.getenv("GUNICORN_THREADS", "8"))  # 仅gthread使用
+
+# sync worker下长流式响应会超过默认30秒的超时
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", "5"))
@@ -0,0 +1,25 @@
+"""
+Image derivative encoding for the DerivativePipeline process pool
+
+Kept separate from app.py so spawned workers only import Pillow, not the
+Flask app with its stores, background threads and template registry.
+"""
+import os
+
+try:
+    from PIL import Image
+except ImportError:  # 未安装Pillow时不生成缩略图/WebP
+    Image = None
+
+def make_image_derivatives(save_path, thumbnail_size, webp_quality):
+    """Create the JPEG and WebP grid thumbnails next to an image (runs in a worker process)"""
+    base, _ = os.path.splitext(save_path)
+    variants = {'thumbnail': f"{base}_thumb.jpg", 'webp': f"{base}_thumb.webp"}
+    with Image.open(save_path) as img:
+        img = img.convert('RGB')
+        img.thumbnail((thumbnail_size, thumbnail_size))
+        img.save(variants['thumbnail'] + '.part', 'JPEG', quality=80, optimize=True, progressive=True)
+        img.save(variants['webp'] + '.part', 'WEBP', quality=webp_quality, method=4)
+    for path in variants.values():
+        os.replace(path + '.part', path)
+    return variants
@@ -19,6 +19,10 @@ class CanvasFlow {
         this.pollingTimerId = null;
         this.backgroundPollingTimerId = null;
         
+        // SSE推送：每个任务一个连接，代替定时轮询
+        this.imageEventSource = null;
+        this.imageEventTaskId = null;
+        
         // 🎯 保存完整的meta prompt用于重新生成
         this.lastMetaPrompt = null;
         
@@ -483,14 +487,17 @@ class CanvasFlow {
         this.streamingMessageElement = messageElement;
         
         let fullResponse = '';
+        let pending = '';
         
         try {
             while (true) {
                 const { done, value } = await reader.read();
                 if (done) break;
                 
-                const chunk = decoder.decode(value, { stream: true });
-                const lines = chunk.split('\n');
+                // 服务器会合并多个token为一帧，帧可能跨越多次read，只处理完整的行
+                pending += decoder.decode(value, { stream: true });
+                const lines = pending.split('\n');
+                pending = lines.pop();
                 
                 for (const line of lines) {
                     if (line.startsWith('data: ')) {
@@ -843,7 +850,7 @@ class CanvasFlow {
                 // 已完成的图片
                 console.log(`🔍 Image${i + 1} 渲染为已完成`);
                 placeholder.innerHTML = `
-                    <img src="${imgData.url}" alt="Generated Image ${i + 1}" class="generated-image" title="${finalPrompt}" data-full-prompt="${finalPrompt}">
+                    ${this.gridImageMarkup(imgData.url, null, i, finalPrompt)}
                     ${shortPrompt ? `<div class="image-prompt-info">${shortPrompt}</div>` : ''}
                 `;
                 placeholder.classList.add('completed');
@@ -1277,6 +1284,9 @@ class CanvasFlow {
             return;
         }
         
+        // Prefer pushed updates; fall back to polling when SSE is unavailable
+        if (this.openImageEventStream()) return;
+        
         try {
             const response = await fetch(`/api/generate_images/${this.currentTaskId}`);
             
@@ -1286,39 +1296,14 @@ class CanvasFlow {
             
             const data = await response.json();
             
-            // Update image status
-            this.updateImageGrid(data.images);
-            
-            // Check if there are still tasks in progress
-            const hasGenerating = data.images.some(img => img.status === 'generating');
-            const hasPending = data.images.some(img => img.status === 'pending');
-            const completedCount = data.images.filter(img => img.status === 'completed').length;
-            const failedCount = data.images.filter(img => img.status === 'failed').length;
-            
             // If there are still images generating or pending, continue polling
-            if (hasGenerating || hasPending) {
+            if (this.handleImageGenerationStatus(data)) {
                 // Clear previous timer
                 if (this.pollingTimerId) {
                     clearTimeout(this.pollingTimerId);
                 }
                 // 设置新的定时器
                 this.pollingTimerId = setTimeout(() => this.pollImageGeneration(), 2000);
-            } 
-            // 如果所有任务都完成了（无论成功还是失败）
-            else if (completedCount + failedCount === 4) {
-                // 清理定时器
-                if (this.pollingTimerId) {
-                    clearTimeout(this.pollingTimerId);
-                    this.pollingTimerId = null;
-                }
-                
-                if (completedCount === 0) {
-                    // 如果没有一张成功，显示错误
-                    this.showImageGenerationError('All image generation failed. Please try again.');
-                } else {
-                    // 有部分成功，显示最终状态
-                    this.finishImageGeneration(completedCount, failedCount);
-                }
             }
             
         } catch (error) {
@@ -1332,6 +1317,90 @@ class CanvasFlow {
         }
     }
     
+    handleImageGenerationStatus(data) {
+        // Apply a task status payload to the visible grid; returns true while images are still in progress
+        // Update image status
+        this.updateImageGrid(data.images);
+        
+        // Check if there are still tasks in progress
+        const hasGenerating = data.images.some(img => img.status === 'generating');
+        const hasPending = data.images.some(img => img.status === 'pending');
+        const completedCount = data.images.filter(img => img.status === 'completed').length;
+        const failedCount = data.images.filter(img => img.status === 'failed').length;
+        
+        if (hasGenerating || hasPending) {
+            return true;
+        }
+        
+        // 如果所有任务都完成了（无论成功还是失败）
+        if (completedCount + failedCount === 4) {
+            // 清理定时器
+            if (this.pollingTimerId) {
+                clearTimeout(this.pollingTimerId);
+                this.pollingTimerId = null;
+            }
+            
+            if (completedCount === 0) {
+                // 如果没有一张成功，显示错误
+                this.showImageGenerationError('All image generation failed. Please try again.');
+            } else {
+                // 有部分成功，显示最终状态
+                this.finishImageGeneration(completedCount, failedCount);
+            }
+        }
+        return false;
+    }
+    
+    openImageEventStream() {
+        // Open (or reuse) the SSE stream for the current task; returns false when EventSource is unsupported
+        if (typeof EventSource === 'undefined') return false;
+        if (this.imageEventSource && this.imageEventTaskId === this.currentTaskId) return true;
+        
+        this.closeImageEventStream();
+        const taskId = this.currentTaskId;
+        const source = new EventSource(`/api/generate_images/${taskId}/events`);
+        this.imageEventSource = source;
+        this.imageEventTaskId = taskId;
+        
+        source.onmessage = (event) => {
+            if (this.currentTaskId !== taskId) {
+                this.closeImageEventStream();
+                return;
+            }
+            const data = JSON.parse(event.data);
+            
+            // 根据当前显示的对话决定更新UI还是只更新历史记录
+            const isForeground = !this.generationChatId || this.currentChatId === this.generationChatId;
+            const stillRunning = isForeground
+                ? this.handleImageGenerationStatus(data)
+                : this.handleBackgroundGenerationStatus(data);
+            if (!stillRunning) {
+                this.closeImageEventStream();
+            }
+        };
+        
+        source.onerror = () => {
+            // 连接中断：关闭推送流，稍后重新检查状态（会重新建立连接）
+            if (this.imageEventSource !== source) return;
+            console.warn('⚠️ Image event stream interrupted, retrying');
+            this.closeImageEventStream();
+            if (this.currentTaskId !== taskId) return;
+            if (this.pollingTimerId) {
+                clearTimeout(this.pollingTimerId);
+            }
+            this.pollingTimerId = setTimeout(() => this.pollImageGeneration(), 5000);
+        };
+        return true;
+    }
+    
+    closeImageEventStream() {
+        if (this.imageEventSource) {
+            this.imageEventSource.close();
+            this.imageEventSource = null;
+            this.imageEventTaskId = null;
+        }
+    }
+    
     async pollImageGenerationBackground() {
         if (!this.currentTaskId) return;
         
@@ -1343,6 +1412,9 @@ class CanvasFlow {
             return;
         }
         
+        // 优先使用推送流，同一个连接在后台继续更新历史记录
+        if (this.openImageEventStream()) return;
+        
         try {
             const response = await fetch(`/api/generate_images/${this.currentTaskId}`);
             
@@ -1352,35 +1424,14 @@ class CanvasFlow {
             
             const data = await response.json();
             
-            // 🆕 每次都更新聊天历史，确保状态同步
-            this.updateBackgroundTaskHistory(data.images, data.images.filter(img => img.status === 'completed').length, data.images.filter(img => img.status === 'failed').length);
-            
-            // 检查是否还有任务正在进行
-            const hasGenerating = data.images.some(img => img.status === 'generating');
-            const hasPending = data.images.some(img => img.status === 'pending');
-            const completedCount = data.images.filter(img => img.status === 'completed').length;
-            const failedCount = data.images.filter(img => img.status === 'failed').length;
-            
             // 如果还有图片在生成中或等待中，继续后台轮询
-            if (hasGenerating || hasPending) {
-                console.log('🔄 后台任务继续进行中...', {completedCount, failedCount});
+            if (this.handleBackgroundGenerationStatus(data)) {
                 // 清理之前的后台定时器
                 if (this.backgroundPollingTimerId) {
                     clearTimeout(this.backgroundPollingTimerId);
                 }
                 // 设置新的后台定时器
                 this.backgroundPollingTimerId = setTimeout(() => this.pollImageGenerationBackground(), 2000);
-            } 
-            // 如果所有任务都完成了，清理任务状态
-            else if (completedCount + failedCount === 4) {
-                console.log('✅ 后台任务完成，清理任务状态', {completedCount, failedCount});
-                // 清理后台定时器
-                if (this.backgroundPollingTimerId) {
-                    clearTimeout(this.backgroundPollingTimerId);
-                    this.backgroundPollingTimerId = null;
-                }
-                this.currentTaskId = null;
-                this.generationChatId = null;
             }
             
         } catch (error) {
@@ -1394,6 +1445,37 @@ class CanvasFlow {
         }
     }
     
+    handleBackgroundGenerationStatus(data) {
+        // 后台任务：只同步聊天历史；返回true表示仍有图片在进行中
+        const completedCount = data.images.filter(img => img.status === 'completed').length;
+        const failedCount = data.images.filter(img => img.status === 'failed').length;
+        
+        // 🆕 每次都更新聊天历史，确保状态同步
+        this.updateBackgroundTaskHistory(data.images, completedCount, failedCount);
+        
+        // 检查是否还有任务正在进行
+        const hasGenerating = data.images.some(img => img.status === 'generating');
+        const hasPending = data.images.some(img => img.status === 'pending');
+        
+        if (hasGenerating || hasPending) {
+            console.log('🔄 后台任务继续进行中...', {completedCount, failedCount});
+            return true;
+        }
+        
+        // 如果所有任务都完成了，清理任务状态
+        if (completedCount + failedCount === 4) {
+            console.log('✅ 后台任务完成，清理任务状态', {completedCount, failedCount});
+            // 清理后台定时器
+            if (this.backgroundPollingTimerId) {
+                clearTimeout(this.backgroundPollingTimerId);
+                this.backgroundPollingTimerId = null;
+            }
+            this.currentTaskId = null;
+            this.generationChatId = null;
+        }
+        return false;
+    }
+    
     updateBackgroundTaskHistory(images, completedCount, failedCount) {
         // Update original chat history
         const generationChat = this.chats[this.generationChatId];
@@ -1477,6 +1559,7 @@ class CanvasFlow {
                 clearTimeout(this.backgroundPollingTimerId);
                 this.backgroundPollingTimerId = null;
             }
+            this.closeImageEventStream();
             return;
         }
         
@@ -1508,8 +1591,8 @@ class CanvasFlow {
                 if (placeholder) {
                     const img = placeholder.querySelector('img');
                     if (img && img.src) {
-                        // Extract relative path
-                        const url = img.src.replace(window.location.origin, '');
+                        // Extract relative path (full-size image, not the grid thumbnail)
+                        const url = (img.dataset.fullSrc || img.src).replace(window.location.origin, '');
                         images.push({status: 'completed', url: url});
                     } else if (placeholder.classList.contains('failed')) {
                         images.push({status: 'failed', url: null});
@@ -1537,6 +1620,7 @@ class CanvasFlow {
             clearTimeout(this.backgroundPollingTimerId);
             this.backgroundPollingTimerId = null;
         }
+        this.closeImageEventStream();
         
         console.log(`Image generation task completed: ${completedCount} successful, ${failedCount} failed`);
     }
@@ -1708,7 +1792,7 @@ class CanvasFlow {
             if (img) {
                 const fullPrompt = selectedPlaceholder.getAttribute('data-full-prompt') || img.title || '';
                 const imageData = {
-                    src: img.src,
+                    src: img.dataset.fullSrc || img.src,
                     alt: img.alt,
                     prompt: fullPrompt,
                     index: this.selectedImageIndex
@@ -1975,6 +2059,18 @@ Please make me feel that you truly understand my artistic preferences!`;
     
 
     
+    gridImageMarkup(url, variants, index, prompt) {
+        // Grid image: WebP thumbnail where supported, JPEG thumbnail otherwise; the full-size URL stays in data-full-src
+        if (!variants && url && url.startsWith('/static/generated_images/')) {
+            // 历史记录只保存原图URL，按命名规则推导缩略图，不存在时onerror回退到原图
+            const base = url.replace(/\.[^./]+$/, '');
+            variants = { thumbnail: `${base}_thumb.jpg`, webp: `${base}_thumb.webp` };
+        }
+        const thumbnail = (variants && variants.thumbnail) || url;
+        const webpSource = variants && variants.webp ? `<source srcset="${variants.webp}" type="image/webp">` : '';
+        return `<picture>${webpSource}<img src="${thumbnail}" data-full-src="${url}" alt="Generated Image ${index + 1}" class="generated-image" title="${prompt}" data-full-prompt="${prompt}" onerror="this.onerror = null; if (this.previousElementSibling) this.previousElementSibling.remove(); this.src = this.dataset.fullSrc;"></picture>`;
+    }
+    
     updateImageGrid(images) {
         if (!this.currentImageGrid) return;
         
@@ -1997,8 +2093,9 @@ Please make me feel that you truly understand my artistic preferences!`;
             
             if (imageData.status === 'completed' && imageData.url) {
                 // Image generation completed - ensure complete prompt is stored in title
+                // Show the thumbnail in the grid; keep the full-size URL for viewing and history
                 placeholder.innerHTML = `
-                    <img src="${imageData.url}" alt="Generated Image ${index + 1}" class="generated-image" title="${imagePrompt}" data-full-prompt="${imagePrompt}">
+                    ${this.gridImageMarkup(imageData.url, imageData.variants, index, imagePrompt)}
                     <div class="image-prompt-info">${shortPrompt}</div>
                 `;
                 placeholder.classList.add('completed');
@@ -2134,6 +2231,7 @@ Please make me feel that you truly understand my artistic preferences!`;
                 clearTimeout(this.backgroundPollingTimerId);
                 this.backgroundPollingTimerId = null;
             }
+            this.closeImageEventStream();
             return;
         }
         
@@ -2159,6 +2257,7 @@ Please make me feel that you truly understand my artistic preferences!`;
             clearTimeout(this.backgroundPollingTimerId);
             this.backgroundPollingTimerId = null;
         }
+        this.closeImageEventStream();
     }
     
     retryImageGeneration() {
@@ -2983,7 +3082,7 @@ Please make me feel that you truly understand my artistic preferences!`;
                     if (imageInfo.status === 'completed' && imageInfo.url) {
                         // Image generation completed - display full information including prompt
                         placeholder.innerHTML = `
-                            <img src="${imageInfo.url}" alt="Generated Image ${index + 1}" class="generated-image" title="${imagePrompt}" data-full-prompt="${imagePrompt}">
+                            ${this.gridImageMarkup(imageInfo.url, imageInfo.variants, index, imagePrompt)}
                             <div class="image-prompt-info">${shortPrompt}</div>
                         `;
                         placeholder.classList.remove('generating', 'pending', 'failed');
@@ -3381,7 +3480,7 @@ Please make me feel that you truly understand my artistic preferences!`;
                         imgData.prompt.substring(0, 50) + '...' : (imgData.prompt || '');
                     
                     placeholder.innerHTML = `
-                        <img src="${imgData.url}" alt="Generated Image ${i + 1}" class="generated-image" title="${imgData.prompt || ''}" data-full-prompt="${imgData.prompt || ''}">
+                        ${this.gridImageMarkup(imgData.url, null, i, imgData.prompt || '')}
                         ${shortPrompt ? `<div class="image-prompt-info">${shortPrompt}</div>` : ''}
                     `;
                     placeholder.classList.remove('generating', 'pending', 'failed');
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+Test incremental parsing of streamed PROMPTn: replies
+"""
+
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from app import PromptStreamParser
+
+PROMPTS = [
+    "A cute kitten in a cyberpunk city, neon colors, mechanical details, cinematic lighting",
+    "A cute kitten in a watercolor garden, soft pastel tones, loose brushstrokes, morning light",
+    "A cute kitten as an anime character, cel-shading, vibrant colors, Studio Ghibli inspired",
+    "A cute kitten in a baroque oil painting, dramatic chiaroscuro, rich textures, golden frame"
+]
+
+def feed_in_chunks(text, size):
+    """Feed text through a new parser in chunks of size characters; returns all parsed prompts"""
+    parser = PromptStreamParser()
+    prompts = []
+    for start in range(0, len(text), size):
+        prompts += parser.feed(text[start:start + size])
+    return prompts + parser.finish()
+
+def test_prompt_stream_parser():
+    """Headers in any case and markdown, split at any point, parse to the same four prompts"""
+
+    print("🧪 Testing streamed prompt parsing")
+    print("=" * 60)
+
+    replies = {
+        'upper case with separators': "Here are four variations:\n\n" + "\n---\n".join(
+            f"PROMPT{i}: {prompt}" for i, prompt in enumerate(PROMPTS, 1)
+        ),
+        'mixed case in bold': "\n---\n".join(
+            f"**Prompt {i}:** {prompt}" for i, prompt in enumerate(PROMPTS, 1)
+        ),
+        'mixed case, no separators, wrapped lines': "\n\n".join(
+            ('prompt' if i % 2 else 'Prompt') + f" {i}:\n" + prompt.replace(', ', ',\n', 1)
+            for i, prompt in enumerate(PROMPTS, 1)
+        ),
+    }
+
+    for name, reply in replies.items():
+        # 覆盖标题和分隔符被切断在两个chunk之间的情况
+        for size in (1, 3, 7, 64, len(reply)):
+            prompts = feed_in_chunks(reply, size)
+            assert prompts == PROMPTS, f"{name}, chunk size {size}: {prompts}"
+        print(f"✅ {name}: parsed {len(PROMPTS)} prompts at every chunk size")
+
+    # 过短的prompt被丢弃，标题前的说明文字被忽略
+    prompts = feed_in_chunks(f"Intro text\nPROMPT1: too short\n---\nPROMPT2: {PROMPTS[1]}", 5)
+    assert prompts == [PROMPTS[1]], prompts
+    print("✅ Short prompts and preamble are dropped")
+
+    print("\n" + "=" * 60)
+    print("🎯 Testing completed!")
+
+if __name__ == "__main__":
+    test_prompt_stream_parser()